@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+# This script runs an anthem song like `anthem` and records it as a step
+# of the marabunta version (wall and CPU time, peak memory, SQL queries),
+# see `songs/steps.py`.
+# It is used instead of `anthem` in the operations of `migration.yml`.
+
+# Usage: anthem_step.py songs.module::function [odoo arguments]
+import sys
+
+from songs.steps import run_song
+
+if __name__ == '__main__':
+    sys.exit(run_song(sys.argv[1:]))
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+# This script moves the content of the attachments between the filestore,
+# the database and an S3 object storage with a pool of workers, see
+# `songs/storage.py`.
+
+# Usage: attachment_mover.py file|db|s3 file|db|s3 [--workers N]
+#                            [--max-rate MB/s] [--set-location]
+#                            [--delete-source]
+import sys
+
+from songs.storage import main
+
+if __name__ == '__main__':
+    sys.exit(main())
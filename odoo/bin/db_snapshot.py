@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+# This script restores the newest matching snapshot of the database before
+# the migration, and saves a snapshot after it, see `songs/snapshot.py`.
+# It is called by the entrypoints when DB_SNAPSHOT_CACHE is true.
+
+# Usage: db_snapshot.py restore|save
+import sys
+
+from songs.snapshot import main
+
+if __name__ == '__main__':
+    sys.exit(main())
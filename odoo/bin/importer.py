@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+# This script can be used to import big csv files
+# It cuts the csv file in chunks and loads them with a pool of workers
+# (one by processor), see `songs/importer.py`.
+# If the imported model has a foreign key on itself, use
+# `load_csv_parallel(defer_self_references=True)` in the song.
+
+# Usage: importer.py anthem_target csv_file_path [--workers N]
+#                    [--chunk-size N]
+import sys
+
+from songs.importer import main
+
+if __name__ == '__main__':
+    sys.exit(main())
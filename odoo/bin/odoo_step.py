@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+# This script runs Odoo in the same process and records the installation
+# or upgrade of the addons as a step of the marabunta version (wall and CPU
+# time, peak memory, SQL queries), see `songs/steps.py`.
+# It is used as `install_command` in `migration.yml`.
+
+# Usage: odoo_step.py [odoo arguments]
+
+# the server timezone is UTC, as in odoo-bin, before `time` is imported
+__import__('os').environ['TZ'] = 'UTC'
+
+import sys  # noqa: E402
+
+from songs.steps import run_odoo  # noqa: E402
+
+if __name__ == '__main__':
+    sys.exit(run_odoo(sys.argv[1:]))
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+# This script runs a graph of songs: the songs whose dependencies are done
+# run at the same time in a pool of workers, see `songs/runner.py`.
+
+# Usage: song_runner.py graph_file_path [--workers N] [--retries N]
+import sys
+
+from songs.runner import main
+
+if __name__ == '__main__':
+    sys.exit(main())
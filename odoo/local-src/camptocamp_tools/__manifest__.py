@@ -3,7 +3,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 {'name': 'Camptocamp tools',
  'description': "Camptocamp tools and version controller.",
- 'version': '11.0.1.0.0',
+ 'version': '11.0.1.4.0',
  'author': 'Camptocamp',
  'license': 'AGPL-3',
  'category': 'Others',
@@ -13,8 +13,12 @@
  ],
  'website': 'http://www.camptocamp.com',
  'data': [
+     'data/ir_config_parameter.xml',
+     'data/ir_cron.xml',
      'templates/camptocamp_version_template.xml',
-     'views/camptocamp_version.xml'
+     'templates/camptocamp_index_template.xml',
+     'views/camptocamp_version.xml',
+     'views/camptocamp_index.xml',
  ],
  'installable': True,
  }
@@ -1 +1,3 @@
 from . import camptocamp_version
+from . import camptocamp_index
+from . import camptocamp_metrics
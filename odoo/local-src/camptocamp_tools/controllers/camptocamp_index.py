@@ -0,0 +1,20 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import http, _
+from odoo.http import request
+from odoo.exceptions import UserError
+
+
+class CamptocampIndexController(http.Controller):
+
+    @http.route('/web/camptocamp/tools/indexes', type='http', auth='user',
+                website=False)
+    def camptocamp_indexes(self, *args, **kwargs):
+        if not request.env.user.has_group('base.group_no_one'):
+            raise UserError(_(
+                "Only users with Technical Features activated are allowed."))
+        indexes = request.env['camptocamp.index'].sudo()._index_status()
+        values = {'indexes': indexes}
+        return request.render('camptocamp_tools.camptocamp_indexes_template',
+                              values)
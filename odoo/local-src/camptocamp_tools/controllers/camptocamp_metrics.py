@@ -0,0 +1,33 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import hmac
+import os
+
+from werkzeug.exceptions import NotFound, Forbidden
+
+from odoo import http
+from odoo.http import request
+from .. import metrics
+
+
+class CamptocampMetricsController(http.Controller):
+
+    @http.route('/web/camptocamp/tools/metrics', type='http', auth='none',
+                website=False)
+    def camptocamp_metrics(self, token=None, **kwargs):
+        """ Metrics of the workers for Prometheus, enabled by the
+        environment variable `ODOO_METRICS_TOKEN`
+        """
+        expected = os.environ.get('ODOO_METRICS_TOKEN')
+        if not expected:
+            raise NotFound()
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        if not hmac.compare_digest(token or '', expected):
+            raise Forbidden()
+        return request.make_response(
+            metrics.exposition(),
+            headers=[('Content-Type', 'text/plain; version=0.0.4')],
+        )
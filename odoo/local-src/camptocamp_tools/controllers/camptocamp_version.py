@@ -1,4 +1,3 @@
-
 #  Copyright 2018 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
@@ -6,20 +5,53 @@ from odoo import http, _
 from odoo.http import request
 from odoo.exceptions import UserError
 
+# Orders of the steps of a version
+STEP_ORDERS = {
+    'date': 'date_start, id',
+    'duration': 'wall DESC, id',
+}
+
 
 class CamptocampVersionController(http.Controller):
 
+    def _version_steps(self, order):
+        """ Return the steps recorded by the songs (`songs/steps.py`) by
+        version number
+        """
+        cr = request.env.cr
+        cr.execute("SELECT to_regclass('marabunta_version_step')")
+        if not cr.fetchone()[0]:
+            return {}
+        cr.execute("""SELECT version, name, kind, depth, wall, cpu,
+                             peak_rss / 1048576.0 AS peak_rss_mb,
+                             sql_count, failed
+                      FROM marabunta_version_step
+                      ORDER BY %s;""" % STEP_ORDERS[order])
+        steps = {}
+        for step in cr.dictfetchall():
+            steps.setdefault(step['version'], []).append(step)
+        return steps
+
     @http.route('/web/camptocamp/tools/versions', type='http', auth='user',
                 website=False)
-    def camptocamp_versions(self, *args, **kwargs):
+    def camptocamp_versions(self, order='date', *args, **kwargs):
         if not request.env.user.has_group('base.group_no_one'):
             raise UserError(_(
                 "Only users with Technical Features activated are allowed."))
+        if order not in STEP_ORDERS:
+            order = 'date'
         sql = """SELECT number, date_done
                  FROM marabunta_version
                  ORDER BY date_done DESC;"""
         request.env.cr.execute(sql)
         res = request.env.cr.dictfetchall()
-        values = {'versions': res}
+        steps = self._version_steps(order)
+        for version in res:
+            version['steps'] = steps.get(version['number'], [])
+            version['duration'] = sum(
+                step['wall'] for step in version['steps']
+                if step['depth'] == 0
+            )
+        values = {'versions': res, 'order': order}
         return request.render('camptocamp_tools.camptocamp_versions_template',
                               values)
@@ -0,0 +1,65 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+""" Registry of the indexes needed by the addons
+
+The addons register their indexes when they are imported::
+
+    from odoo.addons.camptocamp_tools.indexes import register_index
+
+    register_index('sale.order', 'sale_order_state_date_index',
+                   columns=['state', 'date_order'],
+                   where="state != 'cancel'")
+
+The indexes are not created by the update of the modules: the model
+`camptocamp.index` builds the missing ones `CONCURRENTLY`, from a cron or
+a song, and rebuilds the invalid ones left by a failed build. They are
+listed on `/web/camptocamp/tools/indexes`.
+"""
+
+import sys
+
+from collections import OrderedDict, namedtuple
+
+Index = namedtuple('Index', 'name model expression method where extension '
+                            'module')
+
+_indexes = OrderedDict()
+
+
+def register_index(model, name, columns=None, expression=None,
+                   method='btree', where=None, extension=None, module=None):
+    """ Register an index on the table of `model`
+
+    :param columns: the columns of the index, or
+    :param expression: the expression of the index, e.g. `url gin_trgm_ops`
+    :param method: the index method (btree, gin, gist, ...)
+    :param where: the predicate of a partial index
+    :param extension: the PostgreSQL extension the index needs
+    :param module: the addon of the index, by default the one calling
+    """
+    if bool(columns) == bool(expression):
+        raise ValueError('Index %s: give either columns or an expression' %
+                         name)
+    if columns:
+        expression = ', '.join('"%s"' % column for column in columns)
+    if module is None:
+        caller = sys._getframe(1).f_globals.get('__name__', '')
+        if caller.startswith('odoo.addons.'):
+            module = caller.split('.')[2]
+    index = Index(name, model, expression, method, where, extension, module)
+    _indexes[name] = index
+    return index
+
+
+def registered_indexes():
+    return list(_indexes.values())
+
+
+def index_definition(index, table):
+    """ Return the statement building an index without locking the table """
+    definition = 'CREATE INDEX CONCURRENTLY IF NOT EXISTS "%s" ON "%s" ' \
+                 'USING %s (%s)' % (index.name, table, index.method,
+                                    index.expression)
+    if index.where:
+        definition += ' WHERE %s' % index.where
+    return definition
@@ -0,0 +1,315 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+""" Metrics of the workers in the Prometheus text format
+
+Each worker counts in memory the duration of its HTTP requests by route,
+their SQL queries (see `patch_cursor`) and the duration of its crons. The
+counters are written in a file per worker in `ODOO_METRICS_DIR` at most
+every `DUMP_INTERVAL` seconds, at the end of a request or a cron. The
+endpoint `/web/camptocamp/tools/metrics` merges the files of all the
+workers: the counters of the workers which stopped are added to
+`retired.json`, so the totals never decrease.
+
+The memory of the workers (against `limit_memory_soft` and
+`limit_memory_hard`) and the connections of their database pool are
+measured when their file is written.
+"""
+
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import psutil
+
+import odoo
+
+METRICS_DIR = os.environ.get('ODOO_METRICS_DIR', '/tmp/odoo-metrics')
+DUMP_INTERVAL = 5
+RETIRED_FILE = 'retired.json'
+# upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.,
+           60., 300.)
+
+_lock = threading.Lock()
+_local = threading.local()
+_worker = {'pid': None, 'file': None, 'dumped': 0.}
+_state = {}
+
+
+def empty_state():
+    return {'requests': {}, 'sql': {}, 'crons': {}}
+
+
+def _check_worker():
+    """ Start the counters of a new worker: the workers are forked from a
+    process which may have counted already
+    """
+    pid = os.getpid()
+    if _worker['pid'] != pid:
+        _worker.update(pid=pid, dumped=time.time(), file=os.path.join(
+            METRICS_DIR, '%d-%d.json' % (pid, time.time() * 1000)
+        ))
+        _state.clear()
+        _state.update(empty_state())
+
+
+def _observe(histograms, label, seconds):
+    histogram = histograms.get(label)
+    if histogram is None:
+        histogram = histograms[label] = {
+            'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0., 'count': 0,
+        }
+    histogram['buckets'][bisect_left(BUCKETS, seconds)] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+def patch_cursor():
+    """ Count the queries of the cursors and their time in the counter of
+    the current thread, when a request set one
+    """
+    execute = odoo.sql_db.Cursor.execute
+    if getattr(execute, 'metrics_counted', False):
+        return
+
+    @functools.wraps(execute)
+    def counted_execute(self, *args, **kwargs):
+        counter = getattr(_local, 'sql', None)
+        if counter is None:
+            return execute(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return execute(self, *args, **kwargs)
+        finally:
+            counter[0] += 1
+            counter[1] += time.time() - started
+
+    counted_execute.metrics_counted = True
+    odoo.sql_db.Cursor.execute = counted_execute
+
+
+@contextmanager
+def measure_request():
+    """ Measure an HTTP request and its queries, the yielded dict receives
+    its route
+    """
+    _local.sql = counter = [0, 0.]
+    started = time.time()
+    values = {'route': None}
+    try:
+        yield values
+    finally:
+        duration = time.time() - started
+        _local.sql = None
+        route = values['route'] or 'none'
+        with _lock:
+            _check_worker()
+            _observe(_state['requests'], route, duration)
+            sql = _state['sql'].setdefault(route, {'queries': 0,
+                                                   'seconds': 0.})
+            sql['queries'] += counter[0]
+            sql['seconds'] += counter[1]
+        dump()
+
+
+def observe_cron(name, duration):
+    with _lock:
+        _check_worker()
+        _observe(_state['crons'], name, duration)
+    dump(force=True)
+
+
+def gauges():
+    """ Return the memory and the database pool of the worker """
+    memory = psutil.Process(os.getpid()).memory_info()
+    values = {'rss': memory.rss, 'vms': memory.vms,
+              'pool_used': 0, 'pool_idle': 0, 'pool_max': 0}
+    pool = odoo.sql_db._Pool
+    if pool is not None:
+        used = sum(1 for __, in_use in pool._connections if in_use)
+        values.update(pool_used=used,
+                      pool_idle=len(pool._connections) - used,
+                      pool_max=pool._maxconn)
+    return values
+
+
+def dump(force=False):
+    """ Write the counters of the worker in its file, at most every
+    `DUMP_INTERVAL` seconds unless `force`
+    """
+    now = time.time()
+    with _lock:
+        _check_worker()
+        if not force and now - _worker['dumped'] < DUMP_INTERVAL:
+            return
+        _worker['dumped'] = now
+        data = dict(_state, pid=_worker['pid'], gauges=gauges())
+        content = json.dumps(data)
+        path = _worker['file']
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(path + '.tmp', 'w') as metrics_file:
+        metrics_file.write(content)
+    os.rename(path + '.tmp', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(total, data):
+    for kind in ('requests', 'crons'):
+        for label, histogram in data[kind].items():
+            merged = total[kind].setdefault(label, {
+                'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0., 'count': 0,
+            })
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'],
+                                                       histogram['buckets'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+    for label, sql in data['sql'].items():
+        merged = total['sql'].setdefault(label, {'queries': 0,
+                                                 'seconds': 0.})
+        merged['queries'] += sql['queries']
+        merged['seconds'] += sql['seconds']
+
+
+def _read(path):
+    try:
+        with open(path) as metrics_file:
+            return json.load(metrics_file)
+    except (IOError, ValueError):
+        return None
+
+
+def collect():
+    """ Return the counters of all the workers and the gauges of the
+    running ones
+    """
+    dump(force=True)
+    total = empty_state()
+    workers = []
+    with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+        retired = _read(retired_path) or empty_state()
+        stopped = False
+        for name in sorted(os.listdir(METRICS_DIR)):
+            if not name.endswith('.json') or name == RETIRED_FILE:
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            data = _read(path)
+            if data is None:
+                continue
+            if _alive(data['pid']):
+                workers.append(data)
+            else:
+                _merge(retired, data)
+                os.remove(path)
+                stopped = True
+        if stopped:
+            with open(retired_path + '.tmp', 'w') as retired_file:
+                json.dump(retired, retired_file)
+            os.rename(retired_path + '.tmp', retired_path)
+    _merge(total, retired)
+    for data in workers:
+        _merge(total, data)
+    return total, workers
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in sorted(labels.items())
+    )
+
+
+def _histogram_lines(name, label, histograms):
+    lines = []
+    for value, histogram in sorted(histograms.items()):
+        cumulated = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulated += count
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(le=bound, **{label: value}), cumulated
+            ))
+        lines.append('%s_sum%s %f' % (name, _labels(**{label: value}),
+                                      histogram['sum']))
+        lines.append('%s_count%s %d' % (name, _labels(**{label: value}),
+                                        histogram['count']))
+    return lines
+
+
+def exposition():
+    """ Return the metrics in the Prometheus text format """
+    total, workers = collect()
+    config = odoo.tools.config
+    lines = [
+        '# HELP odoo_http_request_duration_seconds Duration of the HTTP '
+        'requests by route',
+        '# TYPE odoo_http_request_duration_seconds histogram',
+    ]
+    lines += _histogram_lines('odoo_http_request_duration_seconds', 'route',
+                              total['requests'])
+    lines += [
+        '# HELP odoo_http_request_sql_queries_total SQL queries of the HTTP '
+        'requests by route',
+        '# TYPE odoo_http_request_sql_queries_total counter',
+    ]
+    lines += ['odoo_http_request_sql_queries_total%s %d' % (
+        _labels(route=route), sql['queries']
+    ) for route, sql in sorted(total['sql'].items())]
+    lines += [
+        '# HELP odoo_http_request_sql_seconds_total Time spent in the SQL '
+        'queries of the HTTP requests by route',
+        '# TYPE odoo_http_request_sql_seconds_total counter',
+    ]
+    lines += ['odoo_http_request_sql_seconds_total%s %f' % (
+        _labels(route=route), sql['seconds']
+    ) for route, sql in sorted(total['sql'].items())]
+    lines += [
+        '# HELP odoo_cron_duration_seconds Duration of the crons',
+        '# TYPE odoo_cron_duration_seconds histogram',
+    ]
+    lines += _histogram_lines('odoo_cron_duration_seconds', 'cron',
+                              total['crons'])
+    gauges = [
+        ('odoo_worker_memory_rss_bytes', 'Resident memory of the worker',
+         'rss'),
+        ('odoo_worker_memory_vms_bytes', 'Virtual memory of the worker, '
+         'compared to the memory limits', 'vms'),
+        ('odoo_db_pool_used_connections', 'Connections of the database pool '
+         'in use', 'pool_used'),
+        ('odoo_db_pool_idle_connections', 'Idle connections of the database '
+         'pool', 'pool_idle'),
+        ('odoo_db_pool_max_connections', 'Maximum connections of the '
+         'database pool', 'pool_max'),
+    ]
+    for name, description, key in gauges:
+        lines += ['# HELP %s %s' % (name, description),
+                  '# TYPE %s gauge' % name]
+        lines += ['%s%s %d' % (name, _labels(pid=data['pid']),
+                               data['gauges'][key]) for data in workers]
+    lines += [
+        '# HELP odoo_worker_memory_limit_bytes Memory limits of the workers',
+        '# TYPE odoo_worker_memory_limit_bytes gauge',
+        'odoo_worker_memory_limit_bytes%s %d' % (
+            _labels(limit='soft'), config['limit_memory_soft']
+        ),
+        'odoo_worker_memory_limit_bytes%s %d' % (
+            _labels(limit='hard'), config['limit_memory_hard']
+        ),
+    ]
+    return '\n'.join(lines) + '\n'
@@ -1 +1,8 @@
+from . import camptocamp_index
 from . import ir_attachment
+from . import ir_cron
+from . import ir_fields_converter
+from . import ir_http
+from . import ir_model_data
+from . import ir_qweb
+from . import trgm_name_search
@@ -0,0 +1,167 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+import threading
+import time
+
+from contextlib import closing
+
+import psycopg2
+
+import odoo
+from odoo import models, api
+from ..indexes import registered_indexes, index_definition
+from ..utils import install_trgm_extension
+
+_logger = logging.getLogger(__name__)
+
+BUILD_LOCK = 'camptocamp_index_build'
+
+
+def build_concurrently(dbname, statuses):
+    """ Build indexes without locking their table
+
+    Each index is built in autocommit with its own connection. An index
+    failing to build is logged, the invalid index it leaves is rebuilt by
+    the next build. An advisory lock prevents two builds at the same time.
+    """
+    built = []
+    with closing(odoo.sql_db.db_connect(dbname).cursor()) as cr:
+        cr.autocommit(True)
+        cr.execute('SELECT pg_try_advisory_lock(hashtext(%s))',
+                   (BUILD_LOCK,))
+        if not cr.fetchone()[0]:
+            _logger.info('The indexes are already being built')
+            return built
+        try:
+            for status in statuses:
+                started = time.time()
+                try:
+                    if status['state'] == 'invalid':
+                        cr.execute('DROP INDEX CONCURRENTLY IF EXISTS "%s"' %
+                                   status['name'])
+                    cr.execute(status['definition'])
+                except psycopg2.Error:
+                    _logger.exception('Unable to build the index %s',
+                                      status['name'])
+                    continue
+                _logger.info('Index %s built in %.1fs', status['name'],
+                             time.time() - started)
+                built.append(status['name'])
+        finally:
+            # the connection goes back to the pool with its session locks
+            cr.execute('SELECT pg_advisory_unlock(hashtext(%s))',
+                       (BUILD_LOCK,))
+    return built
+
+
+class CamptocampIndex(models.AbstractModel):
+    _name = 'camptocamp.index'
+    _description = 'Indexes registered by the addons'
+
+    @api.model
+    def _registered_indexes(self):
+        """ Return the registered indexes, extended by the features
+        adding indexes from their configuration
+        """
+        return registered_indexes()
+
+    @api.model
+    def _index_status(self):
+        """ Return the registered indexes of the installed addons, with
+        their state in the database: `valid`, `invalid`, `missing` or
+        `unavailable` (the table or the extension does not exist)
+        """
+        cr = self.env.cr
+        cr.execute("SELECT name FROM ir_module_module "
+                   "WHERE state IN ('installed', 'to upgrade')")
+        installed = {name for name, in cr.fetchall()}
+        cr.execute('SELECT extname FROM pg_extension')
+        extensions = {name for name, in cr.fetchall()}
+        indexes = [index for index in self._registered_indexes()
+                   if index.module is None or index.module in installed]
+        if not indexes:
+            return []
+        cr.execute("""
+            SELECT c.relname, i.indisvalid, pg_relation_size(c.oid)
+            FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname IN %s
+        """, (tuple(index.name for index in indexes),))
+        existing = {name: (valid, size) for name, valid, size
+                    in cr.fetchall()}
+        statuses = []
+        for index in indexes:
+            model = self.env.get(index.model)
+            table = None
+            if model is not None and model._auto and not model._abstract:
+                table = model._table
+            if table:
+                cr.execute('SELECT to_regclass(%s)', (table,))
+                if not cr.fetchone()[0]:
+                    table = None
+            valid, size = existing.get(index.name, (None, 0))
+            if index.name in existing:
+                state = 'valid' if valid else 'invalid'
+            elif not table or (index.extension and
+                               index.extension not in extensions):
+                state = 'unavailable'
+            else:
+                state = 'missing'
+            statuses.append({
+                'name': index.name,
+                'model': index.model,
+                'module': index.module,
+                'table': table,
+                'definition': (index_definition(index, table)
+                               if table else None),
+                'extension': index.extension,
+                'state': state,
+                'size': size,
+            })
+        return statuses
+
+    @api.model
+    def _indexes_to_build(self):
+        """ Return the status of the missing and invalid indexes, create
+        the `pg_trgm` extension if an index needs it
+        """
+        statuses = self._index_status()
+        if any(status['extension'] == 'pg_trgm' and
+               status['state'] == 'unavailable' for status in statuses):
+            if install_trgm_extension(self.env):
+                self.clear_caches()
+                statuses = self._index_status()
+        return [status for status in statuses
+                if status['state'] in ('missing', 'invalid') and
+                status['definition']]
+
+    @api.model
+    def _build_indexes(self):
+        """ Build the missing indexes and rebuild the invalid ones, return
+        the names of the indexes built
+
+        The transaction of the environment is committed first: an index
+        built concurrently waits for the end of the running transactions.
+        """
+        todo = self._indexes_to_build()
+        if not todo:
+            return []
+        self.env.cr.commit()
+        return build_concurrently(self.env.cr.dbname, todo)
+
+    @api.model
+    def _cron_build_indexes(self):
+        """ Build the indexes in a thread
+
+        The cron keeps the row of its job locked in a transaction until the
+        end of the job, an index built concurrently by the job would wait
+        for it forever. The thread builds them after the end of the job.
+        """
+        todo = self._indexes_to_build()
+        if todo:
+            threading.Thread(
+                target=build_concurrently, args=(self.env.cr.dbname, todo),
+                name='camptocamp.index.build',
+            ).start()
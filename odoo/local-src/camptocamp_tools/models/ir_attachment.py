@@ -1,25 +1,66 @@
-
 # Copyright 2018 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
-from odoo import models, api, SUPERUSER_ID
-from ..utils import install_trgm_extension, create_index
+from odoo import models, api, tools, SUPERUSER_ID
+from ..indexes import register_index
+
+# Speed up the initial request made each time a page is (re)loaded:
+# `select id from ir_attachment where url like '/web/content%'`
+register_index('ir.attachment', 'ir_attachment_url_trgm_index',
+               expression='url gin_trgm_ops', method='gin',
+               extension='pg_trgm')
+
+ASSET_URL_PREFIX = '/web/content/'
 
 
 class IrAttachment(models.Model):
     _inherit = 'ir.attachment'
 
-    @api.model_cr
-    def init(self):
-        """ Add index on ir_attachment.url to speed up the initial request
-            made each time a page is (re)loaded :
-            `select id from ir_attachment where url like '/web/content%'`
+    @api.model
+    @tools.ormcache('url_pattern')
+    def _asset_attachment_ids(self, url_pattern):
+        """ Return the ids of the attachments of an asset bundle, as
+        `AssetsBundle.get_attachments` searches them
+
+        The result is kept in the cache of the worker until the attachments
+        of a bundle change, see `_clear_asset_cache`.
+        """
+        self.env.cr.execute("""
+             SELECT max(id)
+               FROM ir_attachment
+              WHERE create_uid = %s
+                AND url like %s
+           GROUP BY datas_fname
+           ORDER BY datas_fname
+        """, [SUPERUSER_ID, url_pattern])
+        return tuple(row[0] for row in self.env.cr.fetchall())
+
+    def _clear_asset_cache(self, url=None):
+        """ Clear the caches when attachments of asset bundles are created,
+        moved or deleted
+
+        The other workers clear their caches at their next request.
         """
-        env = api.Environment(self._cr, SUPERUSER_ID, {})
-        trgm_installed = install_trgm_extension(env)
-        self._cr.commit()
-
-        if trgm_installed:
-            index_name = 'ir_attachment_url_trgm_index'
-            create_index(self._cr, index_name, self._table,
-                         'USING gin (url gin_trgm_ops)')
+        urls = [url] if url else self.mapped('url')
+        if any(url and url.startswith(ASSET_URL_PREFIX) for url in urls):
+            self.clear_caches()
+
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        if vals.get('url'):
+            record._clear_asset_cache(vals['url'])
+        return record
+
+    @api.multi
+    def write(self, vals):
+        self._clear_asset_cache()
+        result = super().write(vals)
+        if vals.get('url'):
+            self._clear_asset_cache(vals['url'])
+        return result
+
+    @api.multi
+    def unlink(self):
+        self._clear_asset_cache()
+        return super().unlink()
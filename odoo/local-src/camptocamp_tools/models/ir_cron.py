@@ -0,0 +1,19 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import time
+
+from odoo import models, api
+from .. import metrics
+
+
+class IrCron(models.Model):
+    _inherit = 'ir.cron'
+
+    @api.model
+    def _callback(self, cron_name, server_action_id, job_id):
+        started = time.time()
+        try:
+            return super()._callback(cron_name, server_action_id, job_id)
+        finally:
+            metrics.observe_cron(cron_name, time.time() - started)
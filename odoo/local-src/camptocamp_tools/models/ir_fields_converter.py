@@ -0,0 +1,28 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo import models, api, _
+
+# {xmlid: (model, res_id)} of the xmlids resolved in bulk by the loaders
+# of the songs (see `songs.common.preresolve_xmlids`)
+IMPORT_XMLIDS_KEY = 'import_xmlid_cache'
+
+
+class IrFieldsConverter(models.AbstractModel):
+    _inherit = 'ir.fields.converter'
+
+    @api.model
+    def db_id_for(self, model, field, subfield, value):
+        """ Take the xmlids resolved in bulk before the load, rather than
+        looking them up and checking their record row by row
+        """
+        xmlids = self.env.context.get(IMPORT_XMLIDS_KEY)
+        if xmlids and subfield == 'id' and value:
+            if '.' not in value:
+                value = '%s.%s' % (
+                    self.env.context.get('_import_current_module', ''), value
+                )
+            comodel, res_id = xmlids.get(value, (None, None))
+            if comodel == field.comodel_name:
+                return res_id, _(u"external id"), []
+        return super().db_id_for(model, field, subfield, value)
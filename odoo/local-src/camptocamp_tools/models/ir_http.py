@@ -0,0 +1,24 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo import models
+from odoo.http import request
+from .. import metrics
+
+metrics.patch_cursor()
+
+
+class IrHttp(models.AbstractModel):
+    _inherit = 'ir.http'
+
+    @classmethod
+    def _dispatch(cls):
+        """ Measure the requests by the first path of their route """
+        with metrics.measure_request() as values:
+            try:
+                return super()._dispatch()
+            finally:
+                endpoint = getattr(request, 'endpoint', None)
+                if endpoint:
+                    routes = endpoint.routing.get('routes')
+                    values['route'] = routes[0] if routes else None
@@ -0,0 +1,51 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo import models, fields, api
+
+# {xmlid: (model, ir.model.data id, res_id, noupdate)} of the records of a
+# batch resolved in bulk by the loaders of the songs
+# (see `songs.common.preresolve_record_xmlids`)
+IMPORT_RECORDS_KEY = 'import_record_xmlids'
+
+
+class IrModelData(models.Model):
+    _inherit = 'ir.model.data'
+
+    @api.model
+    def _update(self, model, module, values, xml_id=False, store=True,
+                noupdate=False, mode='init', res_id=False):
+        """ Update the existing records resolved in bulk before the load,
+        rather than looking up their xmlid row by row
+
+        The xmlids unknown before the load (new records) go through the
+        standard lookup.
+        """
+        records = self.env.context.get(IMPORT_RECORDS_KEY)
+        if records and xml_id:
+            full_xmlid = xml_id if '.' in xml_id else '%s.%s' % (module,
+                                                                 xml_id)
+            imd_model, imd_id, imd_res_id, imd_noupdate = records.get(
+                full_xmlid, (None, None, None, None)
+            )
+            if imd_model == model:
+                if mode == 'update' and imd_noupdate:
+                    return imd_res_id
+                self = self.with_context(install_mode=True)
+                record = self.env[model].browse(imd_res_id)
+                record.write(values)
+                self.browse(imd_id).sudo().write({
+                    'date_update': fields.Datetime.now(),
+                })
+                module, name = full_xmlid.split('.', 1)
+                self.loads[(module, name)] = (model, imd_res_id)
+                for parent_model, parent_field in record._inherits.items():
+                    parent_name = '%s_%s' % (name,
+                                             parent_model.replace('.', '_'))
+                    self.loads[(module, parent_name)] = (
+                        parent_model, record[parent_field].id
+                    )
+                return imd_res_id
+        return super()._update(model, module, values, xml_id=xml_id,
+                               store=store, noupdate=noupdate, mode=mode,
+                               res_id=res_id)
@@ -0,0 +1,32 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo import models
+from odoo.addons.base.ir.ir_qweb.assetsbundle import AssetsBundle
+
+# as in `AssetsBundle.get_attachments`: version, bundle, css part, type
+ASSET_URL_PATTERN = '/web/content/%-{0}/{1}{2}.{3}'
+
+
+class CachedAssetsBundle(AssetsBundle):
+    """ Asset bundle looking up its attachments in the cache of the worker
+    rather than with a query on `ir_attachment` on each page load
+    """
+
+    def get_attachments(self, type, ignore_version=False):
+        if ignore_version:
+            return super().get_attachments(type, ignore_version=True)
+        url_pattern = ASSET_URL_PATTERN.format(
+            self.version, self.name, '.%' if type == 'css' else '', type
+        )
+        attachments = self.env['ir.attachment'].sudo()
+        return attachments.browse(
+            attachments._asset_attachment_ids(url_pattern)
+        )
+
+
+class IrQWeb(models.AbstractModel):
+    _inherit = 'ir.qweb'
+
+    def get_asset_bundle(self, xmlid, files, remains=None, env=None):
+        return CachedAssetsBundle(xmlid, files, remains=remains, env=env)
@@ -0,0 +1,189 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+
+from odoo import models, api, tools
+from ..indexes import Index
+
+_logger = logging.getLogger(__name__)
+
+# e.g. "res.partner:display_name,email,ref,vat; stock.location:name"
+NAME_SEARCH_PARAM = 'camptocamp_tools.trgm_name_search'
+SIMILARITY_PARAM = 'camptocamp_tools.trgm_name_search_similarity'
+# shorter patterns have no trigram to look up in the indexes
+MIN_LENGTH = 3
+
+
+def parse_name_search_fields(value):
+    """ Return {model: [fields]} of the value of the parameter """
+    config = {}
+    for part in (value or '').split(';'):
+        model, __, names = part.partition(':')
+        names = [name.strip() for name in names.split(',') if name.strip()]
+        if model.strip() and names:
+            config[model.strip()] = names
+    return config
+
+
+def column_field(model, name):
+    """ Return the model and the field of the column of a field: the ones
+    of the parent model for an inherited field
+    """
+    field = model._fields[name]
+    while field.inherited:
+        model = model.env[model._fields[field.related[0]].comodel_name]
+        field = model._fields[name]
+    return model, field
+
+
+def trgm_search(model, fields, name, args=None, limit=None):
+    """ Return the ids of the records of `model` whose `fields` contain
+    `name`, with an `ilike` PostgreSQL answers with the trigram indexes
+    """
+    indexes = model.env['camptocamp.index']
+    model.check_access_rights('read')
+    query = model._where_calc(args or [])
+    model._apply_ir_rules(query, 'read')
+    columns = [model._inherits_join_calc(model._table, fname, query)
+               for fname in fields]
+    order = model._generate_order_by_inner(model._table, model._order, query)
+    from_clause, where_clause, params = query.get_sql()
+    conditions = ['(%s)' % ' OR '.join('%s ILIKE %%s' % column
+                                       for column in columns)]
+    params = params + ['%%%s%%' % name] * len(columns)
+    if where_clause:
+        conditions.insert(0, where_clause)
+    if indexes._trgm_similarity():
+        order.insert(0, 'greatest(%s) DESC' % ', '.join(
+            'similarity(%s, %%s)' % column for column in columns
+        ))
+        params += [name] * len(columns)
+    model.env.cr.execute(
+        'SELECT "%s".id FROM %s WHERE %s ORDER BY %s LIMIT %%s' % (
+            model._table, from_clause, ' AND '.join(conditions),
+            ', '.join(order),
+        ),
+        params + [limit],
+    )
+    return [row[0] for row in model.env.cr.fetchall()]
+
+
+def make_name_search():
+    """ Return a `_name_search` to patch on a model
+
+    The `ilike` on the name of the default `_name_search` is replaced by an
+    `ilike` on the configured fields, in one query answered with the
+    trigram indexes. The models which override `name_search` (partners,
+    products, locations, ...) keep running their own query: the indexes of
+    the configured fields serve it when they are the fields it searches.
+    """
+    @api.model
+    def _name_search(self, name='', args=None, operator='ilike', limit=100,
+                     name_get_uid=None):
+        indexes = self.env['camptocamp.index']
+        fields = indexes._trgm_name_search_fields(self._name) or []
+        # the terms of the translated fields are not in their column
+        translated = any(column_field(self, fname)[1].translate
+                         for fname in fields)
+        if (not fields or operator != 'ilike' or
+                len(name or '') < MIN_LENGTH or
+                not indexes._trgm_ready() or
+                translated and self.env.lang not in (None, 'en_US')):
+            return _name_search.origin(self, name=name, args=args,
+                                       operator=operator, limit=limit,
+                                       name_get_uid=name_get_uid)
+        model = self.sudo(name_get_uid) if name_get_uid else self
+        ids = trgm_search(model, fields, name, args=args, limit=limit)
+        return model.browse(ids).name_get()
+
+    _name_search.trgm_name_search = True
+    return _name_search
+
+
+class CamptocampIndex(models.AbstractModel):
+    _inherit = 'camptocamp.index'
+
+    @api.model
+    def _trgm_name_search_config(self, warn=False):
+        """ Return {model: [fields]} of the configured name searches
+
+        Only the stored char and text fields of the models of the registry
+        are kept, the others are logged with `warn`.
+        """
+        value = self.env['ir.config_parameter'].sudo().get_param(
+            NAME_SEARCH_PARAM
+        )
+        config = {}
+        for model_name, names in parse_name_search_fields(value).items():
+            model = self.env.get(model_name)
+            if model is None:
+                continue
+            fields = []
+            for name in names:
+                field = None
+                if name in model._fields:
+                    field = column_field(model, name)[1]
+                if (field is None or not field.store or
+                        field.type not in ('char', 'text')):
+                    if warn:
+                        _logger.warning('%s.%s cannot be searched with a '
+                                        'trigram index', model_name, name)
+                    continue
+                fields.append(name)
+            if fields:
+                config[model_name] = fields
+        return config
+
+    @api.model
+    def _trgm_name_search_fields(self, model_name):
+        return self._trgm_name_search_config().get(model_name)
+
+    @api.model
+    @tools.ormcache()
+    def _trgm_ready(self):
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _trgm_similarity(self):
+        value = self.env['ir.config_parameter'].sudo().get_param(
+            SIMILARITY_PARAM, 'True'
+        )
+        return value.lower() not in ('false', '0', '')
+
+    @api.model
+    def _registered_indexes(self):
+        """ Add a trigram index on the column of each searched field, on
+        the table of the parent model for an inherited field
+        """
+        indexes = super()._registered_indexes()
+        names = {index.name for index in indexes}
+        for model_name, fields in self._trgm_name_search_config().items():
+            for fname in fields:
+                model = column_field(self.env[model_name], fname)[0]
+                index_name = '%s_%s_trgm_index' % (model._table, fname)
+                if index_name in names:
+                    continue
+                names.add(index_name)
+                indexes.append(Index(
+                    index_name, model._name, '"%s" gin_trgm_ops' % fname,
+                    'gin', None, 'pg_trgm', 'camptocamp_tools',
+                ))
+        return indexes
+
+    @api.model_cr
+    def _register_hook(self):
+        """ Patch `_name_search` on the configured models
+
+        A model added in the parameter is patched at the next start.
+        """
+        super()._register_hook()
+        for model_name in self._trgm_name_search_config(warn=True):
+            model_class = type(self.env[model_name])
+            if not getattr(model_class._name_search, 'trgm_name_search',
+                           False):
+                model_class._patch_method('_name_search',
+                                          make_name_search())
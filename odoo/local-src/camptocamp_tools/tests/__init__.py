@@ -0,0 +1 @@
+from . import test_trgm_name_search
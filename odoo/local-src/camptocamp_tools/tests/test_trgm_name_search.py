@@ -0,0 +1,99 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo.tests import common
+
+from ..models.trgm_name_search import NAME_SEARCH_PARAM
+
+
+# the models are patched by `_register_hook`, after the installation
+@common.at_install(False)
+@common.post_install(True)
+class TestTrgmNameSearch(common.TransactionCase):
+    """ The patched `_name_search` searches the configured fields, the
+    `name_search` of the models keep their searches
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.env['ir.config_parameter'].sudo().set_param(
+            NAME_SEARCH_PARAM,
+            'res.partner:display_name,email,ref,vat; '
+            'product.product:default_code,name; '
+            'stock.location:complete_name,barcode',
+        )
+
+    def _require(self, model_name):
+        if model_name not in self.env:
+            self.skipTest('%s is not installed' % model_name)
+        model = self.env[model_name]
+        self.assertTrue(
+            getattr(type(model)._name_search, 'trgm_name_search', False)
+        )
+        return model
+
+    def _found(self, model, name):
+        return [record_id for record_id, __ in model.name_search(name)]
+
+    def test_partner(self):
+        partners = self._require('res.partner')
+        partner = partners.create({
+            'name': 'Trigram Partner',
+            'email': 'trigram.partner@example.com',
+            'ref': 'TRGM-REF-01',
+            'vat': 'CHE123456788',
+        })
+        self.assertIn(partner.id, self._found(partners, 'Trigram Part'))
+        self.assertIn(partner.id, self._found(partners, 'partner@example'))
+        self.assertIn(partner.id, self._found(partners, 'TRGM-REF'))
+        self.assertIn(partner.id, self._found(partners, 'CHE123456788'))
+
+    def test_name_search_fields(self):
+        partners = self._require('res.partner')
+        if not self.env['camptocamp.index']._trgm_ready():
+            self.skipTest('pg_trgm is not installed')
+        partner = partners.create({
+            'name': 'Trigram Fields',
+            'email': 'trigram.fields@example.com',
+        })
+        other = partners.create({'name': 'Trigram Other'})
+        # the `ilike` on the name is done on all the configured fields
+        ids = [record_id for record_id, __
+               in partners._name_search('fields@example')]
+        self.assertEqual(ids, [partner.id])
+        ids = [record_id for record_id, __ in partners._name_search(
+            'Trigram', args=[('id', '!=', partner.id)]
+        )]
+        self.assertIn(other.id, ids)
+        self.assertNotIn(partner.id, ids)
+
+    def test_product(self):
+        products = self._require('product.product')
+        product = products.create({
+            'name': 'Trigram Product',
+            'default_code': 'TRGM01',
+            'barcode': '4006381333931',
+        })
+        self.assertIn(product.id, self._found(products, 'Trigram Prod'))
+        # exact barcode and `[code] name` of the name_search of the products
+        self.assertIn(product.id, self._found(products, '4006381333931'))
+        self.assertIn(product.id,
+                      self._found(products, '[TRGM01] Trigram Product'))
+
+    def test_location(self):
+        locations = self._require('stock.location')
+        parent = locations.create({'name': 'TRGMWH', 'usage': 'view'})
+        location = locations.create({
+            'name': 'Stock', 'location_id': parent.id, 'barcode': 'TRGMLOC01',
+        })
+        # the full name and the barcode of the name_search of the locations
+        self.assertIn(location.id, self._found(locations, 'TRGMWH/Stock'))
+        self.assertIn(location.id, self._found(locations, 'TRGMLOC01'))
+
+    def test_limit(self):
+        partners = self._require('res.partner')
+        for idx in range(5):
+            partners.create({'name': 'Trigram Limit %d' % idx})
+        result = partners.name_search('Trigram Limit', limit=3)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(len({record_id for record_id, __ in result}), 3)
@@ -0,0 +1,66 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Benchmark of the CSV loaders
+
+These songs are run by `invoke benchmark.run` against a scratch database.
+The path of the file to load (relative to the project) and the model are
+given in the BENCHMARK_PATH and BENCHMARK_MODEL environment variables. The
+statistics of the load are written in JSON in the BENCHMARK_STATS file.
+
+"""
+
+import json
+import os
+
+import anthem
+
+from .common import (load_csv, load_csv_batched, load_csv_copy,
+                     load_csv_parallel, deferred_link_self_references)
+from .metrics import measure
+
+
+def _run(ctx, loader):
+    path = os.environ['BENCHMARK_PATH']
+    model = os.environ['BENCHMARK_MODEL']
+    with measure(ctx.env.cr) as stats:
+        loader(ctx, path, model)
+        ctx.env.cr.commit()
+    with open(os.environ['BENCHMARK_STATS'], 'w') as stats_file:
+        json.dump(stats, stats_file, indent=2)
+
+
+@anthem.log
+def run_load_csv(ctx):
+    """ Benchmark: load_csv """
+    _run(ctx, load_csv)
+
+
+@anthem.log
+def run_batched(ctx):
+    """ Benchmark: load_csv_batched """
+    _run(ctx, load_csv_batched)
+
+
+@anthem.log
+def run_copy(ctx):
+    """ Benchmark: load_csv_copy """
+    _run(ctx, lambda ctx, path, model: load_csv_copy(
+        ctx, model, path, recompute=True, checkpoint=False
+    ))
+
+
+@anthem.log
+def load_parallel(ctx):
+    """ Benchmark: load_csv_parallel, called by importer.py """
+    load_csv_parallel(ctx, os.environ['BENCHMARK_MODEL'],
+                      os.environ['BENCHMARK_PATH'],
+                      defer_self_references=True, checkpoint=False)
+
+
+@anthem.log
+def run_link_parallel(ctx):
+    """ Benchmark: second phase of load_csv_parallel """
+    _run(ctx, lambda ctx, path, model: deferred_link_self_references(
+        ctx, model, path, incremental=True
+    ))
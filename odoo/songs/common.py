@@ -4,10 +4,23 @@
 from builtins import str
 
 from pkg_resources import Requirement, resource_stream
+from anthem.exceptions import AnthemError
 from anthem.lyrics.loaders import load_csv_stream
 from anthem.lyrics.records import switch_company
 
+import codecs
+import collections
+import csv
+import hashlib
+import io
 import os
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from . import formats
+from .metrics import emit_event, measure
 
 req = Requirement.parse('geo_11-odoo')
 
@@ -25,6 +38,170 @@ def load_csv(ctx, path, model, delimiter=',',
                     header=header, header_exclude=header_exclude)
 
 
+def read_csv_rows(content, delimiter=',', encoding='utf-8'):
+    """ Yield the rows of a binary CSV stream one at a time.
+
+    Unlike anthem's `read_csv`, the file is never held in memory as a whole.
+    """
+    reader = csv.reader(codecs.iterdecode(content, encoding),
+                        delimiter=delimiter)
+    for row in reader:
+        yield row
+
+
+def batched(rows, size):
+    """ Group an iterable of rows in lists of at most `size` rows """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_batch(ctx, model, header, rows):
+    """ Load rows with `model.load()` and return the ids of the records
+
+    Raise an `AnthemError` with the import messages if the load failed.
+    """
+    result = model.load(header, rows)
+    ids = result['ids']
+    if not ids:
+        messages = '\n'.join(
+            '- %s' % msg['message'] for msg in result['messages']
+        )
+        raise AnthemError('Failed to load %d rows in %s:\n%s' %
+                          (len(rows), model._name, messages))
+    return ids
+
+
+def load_csv_stream_batched(ctx, model, content, batch_size=1000,
+                            delimiter=',', header=None, header_exclude=None,
+                            commit=False, skip_errors=False,
+                            xmlid_cache=None, defer_recompute=False):
+    """Load a CSV stream in batches of `batch_size` rows.
+
+    Return the number of rows loaded and the number of failed batches.
+
+    The stream is read as a generator and each batch is loaded with its
+    own call to `model.load()`, so the memory used stays flat whatever the
+    size of the file.
+
+    Each batch is loaded in a savepoint. With `commit=True`, the
+    transaction is committed after each batch: a failure only rolls back
+    the current batch. With `skip_errors=True`, a failing batch is rolled
+    back to its savepoint and logged, and the loading goes on with the
+    next one.
+
+    With a `xmlid_cache` (see `get_xmlid_cache`), the xmlids of the
+    relation columns of each batch are resolved in bulk before the load.
+    `camptocamp_tools` makes `model.load()` take them from the context
+    (`import_xmlid_cache`) rather than looking them up row by row. The
+    xmlids of the `id` column are resolved the same way
+    (`import_record_xmlids`): the existing records are updated without
+    looking up their xmlid in `ir.model.data._update()`.
+
+    With `defer_recompute=True`, the stored computed fields of `model` are
+    not computed during the load: the records to recompute are saved after
+    each batch and computed at the end with `deferred_compute_fields`. The
+    fields of other models depending on the loaded records are computed
+    after each batch.
+
+    Usage::
+
+        @anthem.log
+        def import_customers(ctx):
+            content = resource_stream(req, 'data/sample/customers.csv')
+            load_csv_stream_batched(ctx, 'res.partner', content,
+                                    batch_size=5000, commit=True)
+
+    """
+    if isinstance(model, str):
+        model = ctx.env[model]
+    if defer_recompute:
+        model = model.with_context(recompute=False)
+    # keep the loaded records for an incremental computation of the parents
+    defer_parents = (model._parent_store and
+                     model.env.context.get('defer_parent_store_computation'))
+    rows = read_csv_rows(content, delimiter=delimiter)
+    file_header = next(rows, None)
+    if not file_header:
+        return 0, 0
+    header = header or file_header
+    # columns of `header_exclude` missing in the file are ignored
+    header_exclude = header_exclude or []
+    columns = [file_header.index(name) for name in header
+               if name not in header_exclude]
+    header = [file_header[idx] for idx in columns]
+    if columns != list(range(len(file_header))):
+        rows = ([row[idx] for idx in columns] for row in rows)
+    batch_model = model
+
+    total_rows = errors = 0
+    total_start = time.time()
+    for number, batch in enumerate(batched(rows, batch_size), 1):
+        start = time.time()
+        if xmlid_cache is not None:
+            batch_model = model.with_context(
+                import_xmlid_cache=preresolve_xmlids(xmlid_cache, model,
+                                                     header, batch),
+                import_record_xmlids=preresolve_record_xmlids(
+                    xmlid_cache, model, header, batch
+                ),
+            )
+        try:
+            with ctx.env.cr.savepoint():
+                ids = load_batch(ctx, batch_model, header, batch)
+                if defer_parents:
+                    save_touched_records(ctx.env.cr, model,
+                                         model._parent_name, ids)
+                if defer_recompute:
+                    save_recompute_todo(model)
+        except AnthemError as err:
+            if not skip_errors:
+                raise
+            errors += 1
+            ctx.log_line('Batch %d failed, skipped: %s' % (number, err))
+            continue
+        finally:
+            # drop the records loaded so far from the cache
+            ctx.env.invalidate_all()
+        if commit:
+            ctx.env.cr.commit()
+        elapsed = time.time() - start
+        total_rows += len(batch)
+        ctx.log_line('Batch %d: %d rows in %.2fs (%.0f rows/s)' % (
+            number, len(batch), elapsed, len(batch) / (elapsed or 1e-6)
+        ))
+    elapsed = time.time() - total_start
+    ctx.log_line('Loaded %d rows in %.2fs (%.0f rows/s), %d failed batches' % (
+        total_rows, elapsed, total_rows / (elapsed or 1e-6), errors
+    ))
+    return total_rows, errors
+
+
+def load_csv_batched(ctx, path, model, batch_size=1000, delimiter=',',
+                     header=None, header_exclude=None, commit=False,
+                     skip_errors=False, cache_xmlids=True,
+                     defer_recompute=False):
+    """Load a CSV file of the project in batches.
+
+    See `load_csv_stream_batched`.
+    """
+    if isinstance(model, str):
+        model = ctx.env[model]
+    xmlid_cache = get_xmlid_cache(ctx, model) if cache_xmlids else None
+    for content in csv_streams(resource_stream(req, path)):
+        load_csv_stream_batched(ctx, model, content, batch_size=batch_size,
+                                delimiter=delimiter, header=header,
+                                header_exclude=header_exclude, commit=commit,
+                                skip_errors=skip_errors,
+                                xmlid_cache=xmlid_cache,
+                                defer_recompute=defer_recompute)
+
+
 def load_users_csv(ctx, path, delimiter=','):
     # make sure we don't send any email
     model = ctx.env['res.users'].with_context({
@@ -50,34 +227,209 @@ def load_warehouses(ctx, company, path):
         load_csv(ctx, path, 'stock.warehouse')
 
 
-def get_files(default_file):
-    """ Check if there is a DATA_DIR in environment else open default_file.
+def csv_record_offsets(data):
+    """ Yield the end offset of each record of a binary CSV stream
+
+    A record can span several lines when a quoted value contains line
+    breaks: it ends on the first line where the quotes are balanced.
+    """
+    offset = quotes = 0
+    for line in data:
+        offset += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            quotes = 0
+            yield offset
+
+
+def read_chunk(path, start, end):
+    """ Return a stream with the header of a CSV file and a range of rows """
+    with open(path, 'rb') as data:
+        header_end = next(csv_record_offsets(data), 0)
+        data.seek(0)
+        header = data.read(header_end)
+        data.seek(start)
+        return io.BytesIO(header + data.read(end - start))
+
+
+def csv_streams(content, tables=False):
+    """ Yield the CSV streams of a data file (see `songs.formats`)
 
-    DATA_DIR is passed by importer.sh when importing splitted file in parallel
+    A compressed file gives one decompressed stream, a Parquet or Arrow file
+    gives one stream per batch of rows, with the header. With `tables=True`,
+    the batches of a Parquet or Arrow file are yielded as Arrow Tables.
+    """
+    kind = formats.sniff(content)
+    if kind in formats.COMPRESSED:
+        yield formats.decompress(content, kind)
+    elif kind in formats.COLUMNAR:
+        for table in formats.ColumnarFile(content, kind).iter_tables():
+            yield table if tables else formats.table_csv(table)
+    else:
+        yield content
+
+
+def get_files(default_file, tables=False):
+    """ Check if the importer gives a chunk in environment else open
+    default_file.
 
-    Returns a generator of file to import as DATA_DIR can contain a split of
-    csv file
+    IMPORTER_FILE and IMPORTER_CHUNK (`start:end` byte offsets, or row
+    numbers for a Parquet or Arrow file) are passed by the importer
+    (`bin/importer.py`) when importing a file in parallel.
+
+    default_file can be compressed or columnar, see `csv_streams`.
+
+    Returns a generator of file to import
     """
     try:
-        dir_path = os.environ['DATA_DIR']
+        chunk = os.environ['IMPORTER_CHUNK']
     except KeyError:
-        yield resource_stream(req, default_file)
+        for content in csv_streams(resource_stream(req, default_file),
+                                   tables=tables):
+            yield content
     else:
-        file_list = os.listdir(dir_path)
-        for file_name in file_list:
-            file_path = os.path.join(dir_path, file_name)
-            yield open(file_path)
+        path = os.environ['IMPORTER_FILE']
+        start, end = (int(offset) for offset in chunk.split(':'))
+        kind = formats.sniff_file(path)
+        if kind in formats.COLUMNAR:
+            table = formats.read_rows(path, kind, start, end)
+            yield table if tables else formats.table_csv(table)
+        else:
+            yield read_chunk(path, start, end)
+
+
+def ensure_table(cr, table, ddl):
+    """ Create a table of the songs if it does not exist yet
+
+    `ddl` is formatted with the name of the table. The processes creating
+    it at the same time (the workers of the importer or of the song runner)
+    wait for the first one.
+    """
+    cr.execute('SELECT to_regclass(%s)', (table,))
+    if cr.fetchone()[0]:
+        return
+    cr.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (table,))
+    cr.execute(ddl.format(table=table))
+
+
+CHECKPOINT_TABLE = 'marabunta_import_checkpoint'
+CHECKPOINT_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        fingerprint varchar PRIMARY KEY,
+        path varchar,
+        date_done timestamp without time zone
+    )
+"""
+
+
+def content_fingerprint(content, *keys):
+    """ Return a sha1 of a stream and of `keys`, and the rewound stream
+
+    The stream is read by blocks. A stream which cannot be rewound (zstd)
+    is copied in a temporary file while it is read, and the temporary file
+    is returned. An Arrow Table is fingerprinted by its IPC serialization.
+    """
+    digest = hashlib.sha1()
+    for key in keys:
+        digest.update(str(key).encode('utf-8') + b'\0')
+    if formats.is_table(content):
+        digest.update(formats.table_bytes(content))
+        return digest.hexdigest(), content
+    spool = None if content.seekable() else tempfile.TemporaryFile()
+    for block in iter(lambda: content.read(1 << 20), b''):
+        digest.update(block)
+        if spool:
+            spool.write(block)
+    if spool:
+        content = spool
+    content.seek(0)
+    return digest.hexdigest(), content
+
+
+def checkpointed_files(ctx, csv_path, *keys, tables=False):
+    """ Like `get_files`, but skip the chunks already loaded
+
+    Each chunk is fingerprinted by its content and `keys` (the model and
+    the options of the load). The fingerprint is recorded in
+    `marabunta_import_checkpoint` once the caller asks for the next chunk,
+    that is once the chunk has been loaded without error, in the same
+    transaction as the load. Re-running a failed or unchanged import only
+    loads the chunks which are new or changed.
+
+    To force a new load, delete the rows of the table.
+    """
+    cr = ctx.env.cr
+    ensure_table(cr, CHECKPOINT_TABLE, CHECKPOINT_DDL)
+    for content in get_files(csv_path, tables=tables):
+        fingerprint, content = content_fingerprint(content, *keys)
+        cr.execute(
+            'SELECT 1 FROM {} WHERE fingerprint = %s'.format(CHECKPOINT_TABLE),
+            (fingerprint,)
+        )
+        if cr.fetchone():
+            ctx.log_line('Chunk %s of %s already loaded, skipped' % (
+                fingerprint, csv_path
+            ))
+            continue
+        yield content
+        cr.execute(
+            "INSERT INTO {} (fingerprint, path, date_done) "
+            "VALUES (%s, %s, now() AT TIME ZONE 'UTC') "
+            "ON CONFLICT DO NOTHING".format(CHECKPOINT_TABLE),
+            (fingerprint, csv_path)
+        )
+
+
+@contextmanager
+def chunk_event(ctx, model, csv_path, loader):
+    """ Emit a structured event (see `songs.metrics.emit_event`) for the
+    load of a chunk
+
+    The block sets the `rows` and `errors` keys of the yielded event. An
+    exception counts as an error and is raised again.
+    """
+    event = {'chunk': os.environ.get('IMPORTER_CHUNK', 'all'),
+             'path': csv_path, 'model': model._name, 'loader': loader,
+             'pid': os.getpid(), 'rows': 0, 'errors': 0}
+    try:
+        with measure(ctx.env.cr) as stats:
+            yield event
+    except Exception:
+        event['errors'] += 1
+        raise
+    finally:
+        event.update(stats)
+        event['rows_per_second'] = event['rows'] / (stats['wall'] or 1e-6)
+        emit_event(event)
+
+
+def self_reference_columns(model):
+    """ Return the CSV columns which can hold a link of a model to itself
+
+    e.g. `location_id`, `location_id/id` and `location_id/.id`
+    for `stock.location`
+    """
+    columns = []
+    for name, field in model._fields.items():
+        if field.type == 'many2one' and field.comodel_name == model._name:
+            columns += [name, name + '/id', name + '/.id']
+    return columns
 
 
 def load_csv_parallel(ctx, model, csv_path,
                       defer_parent_computation=True,
-                      delimiter=','):
+                      delimiter=',',
+                      defer_self_references=False,
+                      batch_size=500,
+                      cache_xmlids=True,
+                      checkpoint=True,
+                      defer_recompute=False):
     """Use me to load an heavy file ~2k of lines or more.
 
-    Then calling this method as a parameter of importer.sh
+    Then calling this method as a parameter of importer.py
 
-    importer.sh will split the file in chunks per number of processor
-    and per 500.
+    importer.py will cut the file in chunks of 500 rows and feed them
+    to one worker per processor.
     This method will be called once per chunk in order to do the csv loading
     on multiple processes.
 
@@ -93,10 +445,46 @@ def load_csv_parallel(ctx, model, csv_path,
 
     Then in `migration.yml`::
 
-        - importer.sh songs.install.inventory::setup_locations /odoo/data/install/stock.location.csv
+        - importer.py songs.install.inventory::setup_locations /odoo/data/install/stock.location.csv
         # if defer_parent_computation=True
         - anthem songs.install.inventory::location_compute_parents
 
+    When the model has a foreign key on itself (`stock.location`,
+    `product.category`, ...), a child can be loaded before its parent.
+    With `defer_self_references=True`, the columns linking the model to
+    itself are held back: all the records are created in parallel, then
+    `deferred_link_self_references` writes the links in a second phase::
+
+        @anthem.log
+        def setup_locations(ctx):
+            load_csv_parallel(
+                ctx,
+                'stock.location',
+                'data/install/stock.location.csv',
+                defer_self_references=True)
+
+        @anthem.log
+        def location_link_parents(ctx):
+            deferred_link_self_references(
+                ctx,
+                'stock.location',
+                'data/install/stock.location.csv')
+
+    And in `migration.yml`::
+
+        - importer.py songs.install.inventory::setup_locations /odoo/data/install/stock.location.csv
+        - anthem songs.install.inventory::location_link_parents
+
+    The rows are loaded in batches of `batch_size` rows. Unless
+    `cache_xmlids` is False, the xmlids of the relation columns are
+    resolved in bulk, in a cache shared by all the chunks a worker loads.
+
+    Unless `checkpoint` is False, the chunks already loaded with the same
+    content are skipped (see `checkpointed_files`).
+
+    With `defer_recompute=True`, the stored computed fields are computed
+    at the end by `deferred_compute_fields` rather than for each batch.
+
     """ # noqa
     load_ctx = ctx.env.context.copy()
     if defer_parent_computation:
@@ -104,15 +492,562 @@ def load_csv_parallel(ctx, model, csv_path,
     if isinstance(model, str):
         model = ctx.env[model]
     model = model.with_context(**load_ctx)
+    header_exclude = None
+    if defer_self_references:
+        header_exclude = self_reference_columns(model)
+    xmlid_cache = get_xmlid_cache(ctx, model) if cache_xmlids else None
+    if checkpoint:
+        files = checkpointed_files(ctx, csv_path, model._name, 'load',
+                                   delimiter, header_exclude)
+    else:
+        files = get_files(csv_path)
+    for content in files:
+        with chunk_event(ctx, model, csv_path, 'load') as event:
+            event['rows'], event['errors'] = load_csv_stream_batched(
+                ctx, model, content, batch_size=batch_size,
+                delimiter=delimiter, header_exclude=header_exclude,
+                xmlid_cache=xmlid_cache, defer_recompute=defer_recompute,
+            )
+
+
+# Types of the fields `load_csv_copy` can load, with their SQL cast
+COPY_FIELD_TYPES = {
+    'char': 'varchar',
+    'text': 'text',
+    'html': 'text',
+    'selection': 'varchar',
+    'integer': 'integer',
+    'float': 'numeric',
+    'monetary': 'numeric',
+    'boolean': 'boolean',
+    'date': 'date',
+    'datetime': 'timestamp',
+    'many2one': 'integer',
+}
+
+# Columns `load_csv_copy` fills itself
+COPY_MAGIC_FIELDS = ('id', 'create_uid', 'create_date', 'write_uid',
+                     'write_date')
+
+
+def load_csv_copy(ctx, model, csv_path, delimiter=',', recompute=False,
+                  checkpoint=True):
+    """Load a heavy file of a plain model with PostgreSQL `COPY`.
+
+    The file is streamed in a staging table with `COPY`, then the records
+    and their xmlids (`id` column) are inserted in one statement, without
+    going through the ORM: no python constraints, no tracking. Use it for
+    flat models only.
+
+    The stored fields missing in the file get their default value, from
+    `default_get()`. The defaults are evaluated once per file: a default
+    which differs by record (a sequence, ...) must be given in the file.
+    The files missing a required field without default are refused.
+
+    Supported columns: stored fields of the types of `COPY_FIELD_TYPES`,
+    many2one fields by xmlid (`partner_id/id`) or database id
+    (`partner_id/.id`). The rows with a xmlid which already exists are
+    refused: this is a path for new records, use `load_csv_parallel` for
+    updates.
+
+    Models with stored computed fields are refused unless `recompute` is
+    True: then the computed fields of the new records are computed after
+    the insertion.
+
+    Like `load_csv_parallel`, it can be called by importer.py, each chunk
+    being copied on its own, and the chunks already loaded are skipped
+    unless `checkpoint` is False.
+
+    The batches of a Parquet or Arrow file are loaded from their typed
+    values, without going through CSV: the columns are sent as arrays of
+    the types of the fields. Their xmlid columns are strings.
+
+    Usage::
+
+        @anthem.log
+        def import_zips(ctx):
+            load_csv_copy(ctx, 'res.better.zip', 'data/install/zip.csv')
+
+    """
+    if isinstance(model, str):
+        model = ctx.env[model]
+    if model._inherits or model._abstract or not model._auto:
+        raise AnthemError('%s cannot be loaded with COPY' % model._name)
+    computed = [name for name, field in model._fields.items()
+                if field.store and field.compute]
+    if computed and not recompute:
+        raise AnthemError(
+            '%s has stored computed fields (%s), use `recompute=True` to '
+            'compute them after the load' % (model._name, ', '.join(computed))
+        )
+    cr = ctx.env.cr
+    default_module = model.env.context.get('_import_current_module', '')
+    if checkpoint:
+        files = checkpointed_files(ctx, csv_path, model._name, 'copy',
+                                   delimiter, recompute, tables=True)
+    else:
+        files = get_files(csv_path, tables=True)
+    for content in files:
+        started = time.time()
+        with chunk_event(ctx, model, csv_path, 'copy') as event:
+            if formats.is_table(content):
+                header = content.column_names
+            else:
+                line = content.readline().decode('utf-8')
+                header = next(csv.reader([line], delimiter=delimiter))
+            ids = _copy_rows(cr, model, header, content, delimiter,
+                             default_module)
+            if recompute and ids:
+                records = model.browse(ids)
+                records.invalidate_cache()
+                for name in computed:
+                    ctx.env.add_todo(model._fields[name], records)
+                model.recompute()
+            event['rows'] = len(ids)
+        elapsed = time.time() - started
+        ctx.log_line('Copied %d rows in %s in %.2fs (%.0f rows/s)' % (
+            len(ids), model._name, elapsed, len(ids) / (elapsed or 1e-6)
+        ))
+
+
+def _copy_rows(cr, model, header, content, delimiter, default_module):
+    """ COPY a CSV stream or an Arrow Table in `model`, return the ids of
+    the new records
+    """
+    typed = formats.is_table(content)
+    cr.execute(
+        'SELECT name, ttype, relation FROM ir_model_fields '
+        'WHERE model = %s AND store AND name IN %s',
+        (model._name, tuple(name.split('/')[0] for name in header))
+    )
+    fields = {name: (ttype, relation) for name, ttype, relation
+              in cr.fetchall()}
+
+    # staging columns are named c0, c1, ... after the position in the file,
+    # they are text, or typed after the fields for an Arrow Table
+    columns = []    # (target column, SQL expression)
+    types = ['text'] * len(header)
+    joins = []
+    checks = []     # (column of the file, SQL expression of unresolved)
+    xmlid = None
+    for idx, name in enumerate(header):
+        col = 's.c%d' % idx
+        field_name, __, subfield = name.partition('/')
+        ttype, relation = fields.get(field_name, (None, None))
+        if name == 'id':
+            xmlid = col
+        elif ttype not in COPY_FIELD_TYPES:
+            raise AnthemError('Column %s of %s: unknown or unsupported field '
+                              'for COPY' % (name, model._name))
+        elif ttype == 'many2one' and subfield == 'id':
+            alias = 'd%d' % idx
+            joins.append(
+                "LEFT JOIN ir_model_data {alias} "
+                "ON {alias}.module = {module} AND {alias}.name = {name} "
+                "AND {alias}.model = {relation}".format(
+                    alias=alias,
+                    module=_sql_xmlid_module(col, default_module),
+                    name=_sql_xmlid_name(col),
+                    relation=_sql_literal(relation),
+                )
+            )
+            columns.append((field_name, '%s.res_id' % alias))
+            checks.append(
+                (name, "%s <> '' AND %s.res_id IS NULL" % (col, alias))
+            )
+        elif subfield and not (ttype == 'many2one' and subfield == '.id'):
+            raise AnthemError('Column %s of %s: unsupported subfield for '
+                              'COPY' % (name, model._name))
+        elif typed:
+            types[idx] = COPY_FIELD_TYPES[ttype]
+            columns.append((field_name, col))
+        else:
+            columns.append((field_name, "NULLIF(%s, '')::%s" % (
+                col, COPY_FIELD_TYPES[ttype]
+            )))
+
+    if not columns:
+        raise AnthemError('No field to load in %s' % model._name)
+    params = {'uid': model.env.uid, 'model': model._name}
+    columns += _copy_defaults(model, {column for column, __ in columns},
+                              params)
+
+    staging_columns = ['c%d' % idx for idx in range(len(header))]
+    cr.execute('DROP TABLE IF EXISTS csv_copy_staging')
+    cr.execute(
+        'CREATE TEMPORARY TABLE csv_copy_staging (%s, __id integer)' %
+        ', '.join('%s %s' % column for column in zip(staging_columns, types))
+    )
+    if typed:
+        cr.execute(
+            'INSERT INTO csv_copy_staging (%s) SELECT * FROM unnest(%s)' % (
+                ', '.join(staging_columns),
+                ', '.join('%%s::%s[]' % sql_type for sql_type in types),
+            ),
+            [column.to_pylist() for column in content.columns],
+        )
+    else:
+        cr.copy_expert(
+            "COPY csv_copy_staging (%s) FROM STDIN WITH CSV DELIMITER %s" % (
+                ', '.join(staging_columns), _sql_literal(delimiter)
+            ),
+            content,
+        )
+    cr.execute(
+        "UPDATE csv_copy_staging SET __id = nextval("
+        "pg_get_serial_sequence(%s, 'id'))", (model._table,)
+    )
+
+    # validation: relations and xmlids
+    for name, condition in checks:
+        cr.execute('SELECT count(*) FROM csv_copy_staging s %s WHERE %s' % (
+            ' '.join(joins), condition
+        ))
+        count = cr.fetchone()[0]
+        if count:
+            raise AnthemError('Column %s of %s: %d unknown xmlids' % (
+                name, model._name, count
+            ))
+    if xmlid:
+        cr.execute(
+            "SELECT count(*) FROM csv_copy_staging s "
+            "JOIN ir_model_data d ON d.module = {module} "
+            "AND d.name = {name}".format(
+                module=_sql_xmlid_module(xmlid, default_module),
+                name=_sql_xmlid_name(xmlid),
+            )
+        )
+        count = cr.fetchone()[0]
+        if count:
+            raise AnthemError('%d xmlids of %s already exist' % (
+                count, model._name
+            ))
+
+    magic = ("%(uid)s, now() AT TIME ZONE 'UTC', "
+             "%(uid)s, now() AT TIME ZONE 'UTC'")
+    query = (
+        'WITH records AS ('
+        ' INSERT INTO "{table}" (id, {columns}, create_uid, create_date,'
+        '  write_uid, write_date)'
+        ' SELECT s.__id, {values}, {magic}'
+        ' FROM csv_copy_staging s {joins}'
+        ' RETURNING id'
+        ')'.format(
+            table=model._table,
+            columns=', '.join('"%s"' % column for column, __ in columns),
+            values=', '.join(value for __, value in columns),
+            magic=magic,
+            joins=' '.join(joins),
+        )
+    )
+    if xmlid:
+        query += (
+            ', xmlids AS ('
+            ' INSERT INTO ir_model_data (module, name, model, res_id,'
+            '  noupdate, date_init, date_update, create_uid, create_date,'
+            '  write_uid, write_date)'
+            ' SELECT {module}, {name}, %(model)s, s.__id, false,'
+            '  now() AT TIME ZONE \'UTC\', now() AT TIME ZONE \'UTC\','
+            '  {magic}'
+            ' FROM csv_copy_staging s JOIN records r ON r.id = s.__id'
+            ' WHERE s.{xmlid} <> \'\''
+            ')'.format(
+                module=_sql_xmlid_module(xmlid, default_module),
+                name=_sql_xmlid_name(xmlid),
+                magic=magic,
+                xmlid=xmlid[len('s.'):],
+            )
+        )
+    query += ' SELECT id FROM records'
+    cr.execute(query, params)
+    ids = [row[0] for row in cr.fetchall()]
+    cr.execute('DROP TABLE csv_copy_staging')
+    return ids
+
+
+def _copy_defaults(model, loaded, params):
+    """ Return the (column, SQL expression) of the default values of the
+    stored fields missing in a file, add their values to `params`
+    """
+    missing = [name for name, field in model._fields.items()
+               if field.store and not field.compute and
+               name not in loaded and name not in COPY_MAGIC_FIELDS]
+    defaults = model.default_get(missing)
+    columns = []
+    required = []
+    for name in missing:
+        field = model._fields[name]
+        value = defaults.get(name)
+        if value is None or (value is False and field.type != 'boolean'):
+            value = None
+        if value is None or field.type not in COPY_FIELD_TYPES:
+            if field.required:
+                required.append(name)
+            continue
+        key = 'default_%s' % name
+        params[key] = value
+        columns.append((name, '%%(%s)s::%s' % (key,
+                                               COPY_FIELD_TYPES[field.type])))
+    if required:
+        raise AnthemError('%s: the required fields %s have no default value '
+                          'and must be in the file' % (model._name,
+                                                       ', '.join(required)))
+    return columns
+
+
+def _sql_literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def _sql_xmlid_module(column, default_module):
+    """ SQL expression of the module of a xmlid column, see `split_xmlid` """
+    return ("CASE WHEN strpos({col}, '.') > 0 "
+            "THEN split_part({col}, '.', 1) ELSE {default} END").format(
+                col=column, default=_sql_literal(default_module))
+
+
+def _sql_xmlid_name(column):
+    return "substr({col}, strpos({col}, '.') + 1)".format(col=column)
+
+
+def split_xmlid(xmlid, default_module=''):
+    """ Split a xmlid in (module, name) the way `model.load()` does """
+    if '.' in xmlid:
+        return tuple(xmlid.split('.', 1))
+    return default_module, xmlid
+
+
+def resolve_xmlids(cr, xmlids, default_module='', model=None,
+                   batch_size=1000):
+    """ Return a dict {xmlid: res_id} for the xmlids found in the database
+
+    The xmlids are resolved with one query per `batch_size` xmlids.
+    When `model` is given, only the xmlids of existing records of this
+    model are returned.
+    """
+    resolved = {}
+    keys = {split_xmlid(xmlid, default_module): xmlid for xmlid in xmlids}
+    if model is None:
+        query = ('SELECT d.module, d.name, d.res_id FROM ir_model_data d '
+                 'WHERE (d.module, d.name) IN %s')
+    else:
+        query = ('SELECT d.module, d.name, d.res_id FROM ir_model_data d '
+                 'JOIN "{}" r ON r.id = d.res_id '
+                 'WHERE (d.module, d.name) IN %s '
+                 'AND d.model = %s'.format(model._table))
+    for batch in batched(keys, batch_size):
+        params = (tuple(batch),)
+        if model is not None:
+            params += (model._name,)
+        cr.execute(query, params)
+        for module, name, res_id in cr.fetchall():
+            resolved[keys[(module, name)]] = res_id
+    return resolved
+
+
+class XmlidCache(object):
+    """ LRU cache of the xmlids resolved during an import
+
+    The xmlids missing in the cache are resolved in bulk with
+    `resolve_xmlids`. The xmlids which do not exist (yet) are not cached.
+    The cache must be cleared when the transaction is rolled back: it
+    could hold the ids of records created in the transaction.
+    """
+
+    def __init__(self, cr, size=100000, default_module=''):
+        self.cr = cr
+        self.size = size
+        self.default_module = default_module
+        self._ids = collections.OrderedDict()
+
+    def full_xmlid(self, xmlid):
+        """ Return the xmlid with its module, as `model.load()` does """
+        return '.'.join(split_xmlid(xmlid, self.default_module))
+
+    def resolve(self, model, xmlids):
+        """ Return a dict {xmlid: res_id} of the xmlids of a model """
+        result = {}
+        missing = set()
+        for xmlid in xmlids:
+            key = (model._name, xmlid)
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                result[xmlid] = self._ids[key]
+            else:
+                missing.add(xmlid)
+        if missing:
+            found = resolve_xmlids(self.cr, missing, model=model,
+                                   default_module=self.default_module)
+            for xmlid, res_id in found.items():
+                self._ids[(model._name, xmlid)] = res_id
+            result.update(found)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+        return result
+
+    def clear(self):
+        self._ids.clear()
+
+
+def get_xmlid_cache(ctx, model):
+    """ Return the xmlid cache of the current import
+
+    The cache lives as long as the anthem context: for an anthem song or
+    for a worker of the importer.
+    """
+    cache = getattr(ctx, 'xmlid_cache', None)
+    if cache is None:
+        cache = XmlidCache(
+            ctx.env.cr,
+            default_module=model.env.context.get('_import_current_module',
+                                                 ''),
+        )
+        ctx.xmlid_cache = cache
+    return cache
+
+
+def clear_xmlid_cache(ctx):
+    """ Forget the xmlids of the import, after a rollback """
+    cache = getattr(ctx, 'xmlid_cache', None)
+    if cache is not None:
+        cache.clear()
+
+
+def column_comodel(model, column):
+    """ Return the model referenced by a `.../id` column, if any """
+    for name in column.split('/')[:-1]:
+        field = model._fields.get(name)
+        if field is None or not field.relational:
+            return None
+        model = model.env[field.comodel_name]
+    return model
+
+
+def preresolve_xmlids(cache, model, header, rows):
+    """ Resolve in bulk the xmlids of the relation columns of a batch
+
+    Return {xmlid: (model, res_id)} for the `import_xmlid_cache` key of
+    the context of `model.load()`, so the xmlids are not resolved row by
+    row during the load. The unknown xmlids are left to `model.load()`.
+    """
+    import_cache = {}
+    for idx, column in enumerate(header):
+        if column == 'id' or not column.endswith('/id'):
+            continue
+        comodel = column_comodel(model, column)
+        if comodel is None:
+            continue
+        xmlids = {cache.full_xmlid(xmlid.strip())
+                  for row in rows if row[idx]
+                  for xmlid in row[idx].split(',')}
+        for xmlid, res_id in cache.resolve(comodel, xmlids).items():
+            import_cache[xmlid] = (comodel._name, res_id)
+    return import_cache
+
+
+def preresolve_record_xmlids(cache, model, header, rows):
+    """ Resolve in bulk the xmlids of the `id` column of a batch
+
+    Return {xmlid: (model, ir.model.data id, res_id, noupdate)} of the
+    existing records, for the `import_record_xmlids` key of the context
+    of `model.load()`. They are not kept in the cache: the `noupdate`
+    flag and the ir.model.data rows are those of the batch only.
+    """
+    if 'id' not in header:
+        return {}
+    idx = header.index('id')
+    keys = {split_xmlid(row[idx].strip(), cache.default_module)
+            for row in rows if row[idx].strip()}
+    records = {}
+    query = ('SELECT d.module, d.name, d.id, d.res_id, d.noupdate '
+             'FROM ir_model_data d '
+             'JOIN "{}" r ON r.id = d.res_id '
+             'WHERE (d.module, d.name) IN %s '
+             'AND d.model = %s'.format(model._table))
+    for batch in batched(keys, 1000):
+        cache.cr.execute(query, (tuple(batch), model._name))
+        for module, name, imd_id, res_id, noupdate in cache.cr.fetchall():
+            records['%s.%s' % (module, name)] = (model._name, imd_id,
+                                                 res_id, noupdate)
+    return records
+
+
+def deferred_link_self_references(ctx, model, csv_path, delimiter=',',
+                                  compute_parents=True, incremental=False):
+    """Second phase of `load_csv_parallel(defer_self_references=True)`.
+
+    Read the links of the records to themselves in the CSV file
+    (`location_id/id` or `location_id/.id` columns, the records being
+    identified by the `id` column), resolve all the xmlids in bulk and
+    write the links with one `write()` per parent.
+
+    The parent store is then computed with `deferred_compute_parents`
+    (`incremental` is given to it), unless `compute_parents` is False.
+    """
+    if isinstance(model, str):
+        model = ctx.env[model]
+    model = model.with_context(defer_parent_store_computation='manually')
+    default_module = model.env.context.get('_import_current_module', '')
     for content in get_files(csv_path):
-        load_csv_stream(ctx, model, content, delimiter=delimiter)
+        rows = read_csv_rows(content, delimiter=delimiter)
+        header = next(rows, None) or []
+        links = []
+        for name in self_reference_columns(model):
+            if name in header:
+                if '/' not in name:
+                    raise AnthemError(
+                        'Column %s: self references must be given by xmlid '
+                        '(%s/id) or by database id (%s/.id)' %
+                        (name, name, name)
+                    )
+                links.append((name.split('/')[0], header.index(name),
+                              name.endswith('/.id')))
+        if not links:
+            ctx.log_line('No self reference in %s' % csv_path)
+            continue
+        if 'id' not in header:
+            raise AnthemError('An `id` column is required to link the '
+                              'records of %s' % csv_path)
+        id_idx = header.index('id')
+        # {field: [(record xmlid, parent xmlid or id)]}
+        values = {field: [] for field, __, __ in links}
+        for row in rows:
+            for field, idx, __ in links:
+                if row[idx]:
+                    values[field].append((row[id_idx], row[idx]))
+
+        for field, __, by_db_id in links:
+            xmlids = {xmlid for xmlid, __ in values[field]}
+            if not by_db_id:
+                xmlids |= {parent for __, parent in values[field]}
+            ids = resolve_xmlids(model.env.cr, xmlids, model=model,
+                                 default_module=default_module)
+            missing = xmlids - set(ids)
+            if missing:
+                raise AnthemError('Unknown xmlids in %s: %s' % (
+                    csv_path, ', '.join(sorted(missing)[:20])
+                ))
+            children = {}
+            for xmlid, parent in values[field]:
+                parent_id = int(parent) if by_db_id else ids[parent]
+                children.setdefault(parent_id, []).append(ids[xmlid])
+            for parent_id, child_ids in children.items():
+                model.browse(child_ids).write({field: parent_id})
+                if field == model._parent_name:
+                    save_touched_records(model.env.cr, model, field,
+                                         child_ids)
+            ctx.log_line('Linked %d records of %s to %d parents (%s)' % (
+                len(values[field]), model._name, len(children), field
+            ))
+    if compute_parents and model._parent_store:
+        deferred_compute_parents(ctx, model._name, incremental=incremental)
 
 
 # Deprecated name for load_csv_parallel
 deferred_import = load_csv_parallel
 
 
-def deferred_compute_parents(ctx, model):
+def deferred_compute_parents(ctx, model, incremental=False):
     """Use me for heavy files after calling `deferred_import`.
 
     Usage::
@@ -121,5 +1056,248 @@ def deferred_compute_parents(ctx, model):
         def location_compute_parents(ctx):
             deferred_compute_parents(ctx, 'stock.location')
 
+    `_parent_store_compute()` rebuilds the parent store of the whole table.
+    With `incremental=True`, only the subtrees of the records created or
+    re-parented by the loaders are computed: they are appended at the end
+    of the range of their parent, the records after being shifted in one
+    pass on the table. Only the loaded records and their descendants are
+    numbered, but the siblings are then no longer sorted by `_parent_order`
+    in the parent store until the next full computation.
+
+    """
+    if incremental:
+        compute_parents_incremental(ctx, ctx.env[model])
+    else:
+        model = ctx.env[model]
+        model._parent_store_compute()
+        # the records saved by the loaders are computed too
+        pop_touched_records(ctx.env.cr, model, model._parent_name)
+
+
+def compute_parents_incremental(ctx, model):
+    """ Compute the parent store of the records touched by the loaders
+
+    The records are the ones saved by the loaders in
+    `marabunta_deferred_compute` for the parent field of the model, plus
+    the ones without `parent_left`.
+    """
+    cr = ctx.env.cr
+    table, parent = model._table, model._parent_name
+    touched = pop_touched_records(cr, model, parent)
+    cr.execute('SELECT id FROM "{}" WHERE parent_left IS NULL '
+               'OR parent_right IS NULL'.format(table))
+    touched.update(row[0] for row in cr.fetchall())
+    if not touched:
+        ctx.log_line('No parent to compute on %s' % model._name)
+        return
+
+    # the touched records and all their descendants, in the order of
+    # the siblings
+    query = """
+        WITH RECURSIVE subtree(id) AS (
+            SELECT id FROM "{table}" WHERE id IN %s
+            UNION
+            SELECT child.id FROM "{table}" child
+            JOIN subtree ON child."{parent}" = subtree.id
+        )
+        SELECT t.id, t."{parent}" FROM "{table}" t
+        JOIN subtree USING (id)
+        ORDER BY {order}
+    """.format(table=table, parent=parent,
+               order=', '.join(filter(None, [model._parent_order, 'id'])))
+    cr.execute(query, (tuple(touched),))
+    nodes = cr.fetchall()
+    moved = {node_id for node_id, __ in nodes}
+    children = {}
+    for node_id, parent_id in nodes:
+        children.setdefault(parent_id, []).append(node_id)
+
+    def number(node_id, pos, values):
+        """ Number a subtree like `_parent_store_compute()` does """
+        left, pos = pos, pos + 1
+        for child_id in children.get(node_id, []):
+            pos = number(child_id, pos, values)
+        values.append((node_id, left, pos))
+        return pos + 1
+
+    # the tops of the moved subtrees, by the parent they are attached to
+    tops = {parent_id: node_ids for parent_id, node_ids in children.items()
+            if parent_id not in moved}
+    points = []
+    parent_ids = [parent_id for parent_id in tops if parent_id is not None]
+    if parent_ids:
+        cr.execute('SELECT parent_right, id FROM "{}" WHERE id IN %s'.format(
+            table), (tuple(parent_ids),))
+        points = sorted(cr.fetchall())
+
+    # the subtrees are appended at the end of the range of their parent:
+    # the records after an insertion point are shifted by the width of
+    # the subtrees inserted before them
+    values = []
+    positions, shifts = [], [0]
+    for right, parent_id in points:
+        pos = right + shifts[-1]
+        for node_id in tops[parent_id]:
+            pos = number(node_id, pos, values)
+        positions.append(right)
+        shifts.append(pos - right)
+    if positions:
+        # one pass on the table, `width_bucket` counts the insertion
+        # points before a position
+        cr.execute("""
+            UPDATE "{}" SET
+                parent_left = parent_left + (%(shifts)s::int[])[
+                    width_bucket(parent_left - 1, %(positions)s::int[]) + 1
+                ],
+                parent_right = parent_right + (%(shifts)s::int[])[
+                    width_bucket(parent_right, %(positions)s::int[]) + 1
+                ]
+            WHERE parent_right >= %(first)s
+        """.format(table), {'shifts': shifts, 'positions': positions,
+                            'first': positions[0]})
+    if None in tops:
+        cr.execute('SELECT coalesce(max(parent_right), -1) + 1 '
+                   'FROM "{}"'.format(table))
+        pos = cr.fetchone()[0]
+        for node_id in tops[None]:
+            pos = number(node_id, pos, values)
+    if values:
+        cr.execute("""
+            UPDATE "{}" t SET parent_left = v.lft, parent_right = v.rgt
+            FROM unnest(%s, %s, %s) AS v(id, lft, rgt)
+            WHERE t.id = v.id
+        """.format(table), [list(col) for col in zip(*values)])
+    model.invalidate_cache(['parent_left', 'parent_right'])
+    ctx.log_line('Computed the parents of %d records of %s' % (
+        len(moved), model._name
+    ))
+
+
+RECOMPUTE_TABLE = 'marabunta_deferred_compute'
+RECOMPUTE_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        model varchar NOT NULL,
+        field varchar NOT NULL,
+        res_id integer NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS {table}_model_field_index
+    ON {table} (model, field);
+"""
+
+
+def save_recompute_todo(model):
+    """ Move the records of `model` to recompute in the database
+
+    Used by the loaders when the computation of the stored fields is
+    deferred (`recompute=False` in context): the records are kept in
+    `marabunta_deferred_compute` until `deferred_compute_fields` is called
+    for `model`, possibly in another process. The fields of the other
+    models to recompute (e.g. the templates of the loaded products) are
+    computed now, nothing would compute them later.
+    """
+    env = model.env
+    for field in list(env.all.todo):
+        if field.model_name != model._name:
+            continue
+        records = env.field_todo(field)
+        if records:
+            save_touched_records(env.cr, model, field.name, records.ids)
+            env.remove_todo(field, records)
+    model.recompute()
+
+
+def save_touched_records(cr, model, field, ids):
+    """ Save records whose `field` must be computed later """
+    ensure_table(cr, RECOMPUTE_TABLE, RECOMPUTE_DDL)
+    cr.execute(
+        'INSERT INTO {} (model, field, res_id) '
+        'SELECT %s, %s, unnest(%s)'.format(RECOMPUTE_TABLE),
+        (model._name, field, list(ids))
+    )
+
+
+def pop_touched_records(cr, model, field):
+    """ Remove the records saved for `field` and return their ids """
+    ensure_table(cr, RECOMPUTE_TABLE, RECOMPUTE_DDL)
+    cr.execute(
+        'DELETE FROM {} WHERE model = %s AND field = %s '
+        'RETURNING res_id'.format(RECOMPUTE_TABLE),
+        (model._name, field)
+    )
+    return {row[0] for row in cr.fetchall()}
+
+
+def deferred_compute_fields(ctx, model, fields=None, batch_size=10000):
+    """Use me after a load with `defer_recompute=True`.
+
+    Compute the stored fields of the records saved by the loaders, by
+    batches of `batch_size` records, committing after each batch. An
+    interrupted computation goes on where it stopped when called again.
+
+    Usage::
+
+        @anthem.log
+        def partner_compute_fields(ctx):
+            deferred_compute_fields(ctx, 'res.partner')
+
+    """
+    if isinstance(model, str):
+        model = ctx.env[model]
+    cr = ctx.env.cr
+    ensure_table(cr, RECOMPUTE_TABLE, RECOMPUTE_DDL)
+    if fields is None:
+        cr.execute(
+            'SELECT DISTINCT field FROM {} WHERE model = %s'.format(
+                RECOMPUTE_TABLE
+            ), (model._name,)
+        )
+        # the other fields are saved for the parent store
+        fields = [row[0] for row in cr.fetchall()
+                  if model._fields[row[0]].compute]
+    for name in fields:
+        field = model._fields[name]
+        total = 0
+        while True:
+            started = time.time()
+            query = """
+                DELETE FROM {table} WHERE ctid IN (
+                    SELECT ctid FROM {table}
+                    WHERE model = %s AND field = %s
+                    LIMIT %s
+                )
+                RETURNING res_id
+            """.format(table=RECOMPUTE_TABLE)
+            cr.execute(query, (model._name, name, batch_size))
+            ids = list({row[0] for row in cr.fetchall()})
+            if not ids:
+                break
+            records = model.browse(ids).exists()
+            ctx.env.add_todo(field, records)
+            model.recompute()
+            cr.commit()
+            ctx.env.invalidate_all()
+            total += len(records)
+            ctx.log_line('Computed %s.%s on %d records in %.2fs (%d)' % (
+                model._name, name, len(records), time.time() - started, total
+            ))
+    cr.execute(
+        'SELECT model, field, count(*) FROM {} WHERE model != %s '
+        'GROUP BY model, field'.format(RECOMPUTE_TABLE), (model._name,)
+    )
+    for other, name, count in cr.fetchall():
+        field = ctx.env[other]._fields.get(name) if other in ctx.env else None
+        # the rows of the other fields are for the parent store
+        if field is not None and field.compute:
+            ctx.log_line('%s.%s is still to compute on %d records, call '
+                         'deferred_compute_fields for %s' % (other, name,
+                                                             count, other))
+
+
+def build_indexes(ctx):
+    """ Build the missing indexes registered in `camptocamp_tools`
+
+    The transaction of the song is committed before the indexes are built
+    concurrently.
     """
-    ctx.env[model]._parent_store_compute()
+    for name in ctx.env['camptocamp.index']._build_indexes():
+        ctx.log_line('Index %s built' % name)
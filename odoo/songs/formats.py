@@ -0,0 +1,203 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Input formats of the data files
+
+Besides plain CSV, the loaders accept:
+
+* CSV files compressed with gzip, or with zstd (requires `zstandard`),
+  decompressed on the fly;
+* Parquet and Arrow IPC (Feather v2) files (requires `pyarrow`), read by
+  batches of rows.
+
+The loaders which can use typed values (`load_csv_copy`) take the batches
+of a columnar file as Arrow Tables, without going through CSV. The other
+loaders (`model.load()` takes strings) get the batches written back as CSV
+streams.
+
+The format is detected from the first bytes of the file, whatever its
+extension.
+"""
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+
+from anthem.exceptions import AnthemError
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'PAR1', 'parquet'),
+    (b'ARROW1', 'arrow'),
+)
+COMPRESSED = ('gzip', 'zstd')
+COLUMNAR = ('parquet', 'arrow')
+
+# rows per CSV stream when a whole columnar file is read
+COLUMNAR_BATCH_ROWS = 50000
+
+
+def sniff(stream):
+    """ Return the format of a seekable binary stream: `csv`, `gzip`,
+    `zstd`, `parquet` or `arrow`
+    """
+    head = stream.read(8)
+    stream.seek(0)
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+    return 'csv'
+
+
+def sniff_file(path):
+    with open(path, 'rb') as data:
+        return sniff(data)
+
+
+def decompress(stream, kind):
+    """ Return a binary stream of the decompressed content of `stream`
+
+    A zstd stream cannot be rewound.
+    """
+    if kind == 'gzip':
+        return gzip.GzipFile(fileobj=stream)
+    if zstandard is None:
+        raise AnthemError('The `zstandard` package is required to read zstd '
+                          'files')
+    reader = zstandard.ZstdDecompressor().stream_reader(stream)
+    return io.BufferedReader(reader)
+
+
+def decompress_to_file(path):
+    """ Decompress a gzip or zstd file in a temporary file
+
+    Return the path of the temporary file, which the caller removes.
+    """
+    handle, target = tempfile.mkstemp(suffix='.csv')
+    with open(path, 'rb') as source, os.fdopen(handle, 'wb') as output:
+        shutil.copyfileobj(decompress(source, sniff(source)), output, 1 << 20)
+    return target
+
+
+class ColumnarFile(object):
+    """ Read the rows of a Parquet or Arrow IPC file
+
+    The file is read by units: the row groups of a Parquet file, the record
+    batches of an Arrow file. The last unit read is kept, so reading
+    consecutive ranges of rows does not read a unit several times.
+    """
+
+    def __init__(self, source, kind):
+        if pyarrow is None:
+            raise AnthemError('The `pyarrow` package is required to read %s '
+                              'files' % kind)
+        if kind == 'parquet':
+            self._file = pyarrow.parquet.ParquetFile(source)
+            metadata = self._file.metadata
+            self.sizes = [metadata.row_group(idx).num_rows
+                          for idx in range(metadata.num_row_groups)]
+        else:
+            if isinstance(source, str):
+                source = pyarrow.memory_map(source)
+            self._file = pyarrow.ipc.open_file(source)
+            self.sizes = [self._file.get_batch(idx).num_rows
+                          for idx in range(self._file.num_record_batches)]
+        self.kind = kind
+        self.num_rows = sum(self.sizes)
+        self._unit = (None, None)
+
+    def read_unit(self, idx):
+        if self._unit[0] != idx:
+            if self.kind == 'parquet':
+                table = self._file.read_row_group(idx)
+            else:
+                table = pyarrow.Table.from_batches(
+                    [self._file.get_batch(idx)]
+                )
+            self._unit = (idx, table)
+        return self._unit[1]
+
+    def read_rows(self, start, end):
+        """ Return a Table of the rows from `start` to `end` (excluded) """
+        tables = []
+        offset = 0
+        for idx, size in enumerate(self.sizes):
+            if offset >= end:
+                break
+            if offset + size > start:
+                first = max(start, offset)
+                tables.append(self.read_unit(idx).slice(
+                    first - offset, min(end, offset + size) - first
+                ))
+            offset += size
+        return pyarrow.concat_tables(tables)
+
+    def iter_tables(self, batch_rows=COLUMNAR_BATCH_ROWS):
+        """ Yield Tables of `batch_rows` rows, one unit read at a time """
+        pending, count = [], 0
+        for idx in range(len(self.sizes)):
+            table = self.read_unit(idx)
+            offset = 0
+            while offset < table.num_rows:
+                part = table.slice(offset, batch_rows - count)
+                pending.append(part)
+                count += part.num_rows
+                offset += part.num_rows
+                if count == batch_rows:
+                    yield pyarrow.concat_tables(pending)
+                    pending, count = [], 0
+        if pending:
+            yield pyarrow.concat_tables(pending)
+
+
+# files opened by a worker of the importer, by path
+_columnar_files = {}
+
+
+def read_rows(path, kind, start, end):
+    """ Return a Table of a range of rows of a columnar file
+
+    The file stays open in the process for the next ranges.
+    """
+    if path not in _columnar_files:
+        _columnar_files[path] = ColumnarFile(path, kind)
+    return _columnar_files[path].read_rows(start, end)
+
+
+def table_csv(table):
+    """ Return a binary CSV stream, with a header, of an Arrow Table """
+    output = io.BytesIO()
+    pyarrow.csv.write_csv(table, output)
+    output.seek(0)
+    return output
+
+
+def is_table(content):
+    """ Return whether a content to load is an Arrow Table """
+    return pyarrow is not None and isinstance(content, pyarrow.Table)
+
+
+def table_bytes(table):
+    """ Return the Arrow IPC serialization of a Table, a buffer """
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue()
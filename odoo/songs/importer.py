@@ -0,0 +1,377 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Import a heavy CSV file with a pool of long-lived workers
+
+Rather than splitting the file in temporary files and starting one `anthem`
+per chunk, the file is cut in chunks of records by byte offsets and the
+chunks are fed to a pool of workers, up to one per processor. Each worker
+loads the Odoo registry once and calls the song once per chunk, in its own
+transaction.
+
+The song reads its chunk through `songs.common.get_files`, which gets the
+file and the byte range from the `IMPORTER_FILE` and `IMPORTER_CHUNK`
+environment variables and puts the CSV header back in front of it.
+
+A gzip or zstd file is decompressed once in a temporary file which is cut
+in chunks. A Parquet or Arrow file is cut in ranges of rows, each worker
+reading the row groups (or record batches) of its ranges.
+
+Usage::
+
+    importer.py songs.install.inventory::setup_locations \\
+        /odoo/data/install/stock.location.csv
+
+The number of workers loading at the same time adapts to the measured
+throughput and contention (see `Tuner`), unless `--no-adaptive` is given.
+The chunk size only adapts with `--adaptive-chunk-size`: the songs skip the
+chunks already loaded by their content (see
+`songs.common.checkpointed_files`), which only works when a failed import
+is run again with the same bounds of chunks.
+
+A chunk failing on a serialization failure, a deadlock or a lock timeout
+(`--lock-timeout`) is retried (`--retries`) rather than failing the
+import.
+
+The import is recorded as a step of the version (see `songs.steps`). With
+`--stats-file`, a summary of the import (rows, time, SQL queries, peak
+memory of the workers) is written in JSON. Any unknown argument is given to
+Odoo.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import itertools
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+from . import formats, process, steps
+from .common import csv_record_offsets
+from .metrics import measure
+
+
+class ChunkReader(object):
+    """ Cut a data file in chunks of records, of the size asked for each
+    chunk
+
+    The header of the file is not part of any chunk. A chunk always ends
+    on a record boundary, even when a quoted value contains line breaks.
+    The bounds of a chunk are byte offsets, or row numbers for a Parquet or
+    Arrow file.
+    """
+
+    def __init__(self, path):
+        kind = formats.sniff_file(path)
+        self.number = self.row = 0
+        self._data = self._offsets = None
+        if kind in formats.COLUMNAR:
+            self.total = formats.ColumnarFile(path, kind).num_rows
+            self.position = 0
+        else:
+            self._data = open(path, 'rb')
+            self._offsets = csv_record_offsets(self._data)
+            self.position = next(self._offsets, None)
+
+    def next_chunk(self, size):
+        """ Return (chunk number, first row, rows, start, end) for the next
+        `size` records, None at the end of the file
+        """
+        start = end = self.position
+        if start is None:
+            return None
+        if self._offsets is None:
+            end = min(start + size, self.total)
+            count = end - start
+        else:
+            count = 0
+            for end in itertools.islice(self._offsets, size):
+                count += 1
+        if not count:
+            return None
+        self.number += 1
+        first_row = self.row + 1
+        self.row += count
+        self.position = end
+        return self.number, first_row, count, start, end
+
+    def close(self):
+        if self._data:
+            self._data.close()
+
+
+def run_chunk(args):
+    """ Load a chunk of the file in a worker, return a report of the load
+
+    A load failing on a serialization failure, a deadlock or a lock
+    timeout is retried (see `process.run_target`).
+    """
+    target, path, chunk, retries, lock_timeout = args
+    number, first_row, rows, start, end = chunk
+    ctx = process.worker_context()
+    os.environ['IMPORTER_FILE'] = path
+    os.environ['IMPORTER_CHUNK'] = '%d:%d' % (start, end)
+    with measure(ctx.env.cr) as stats:
+        error, attempt = process.run_target(ctx, target, retries=retries,
+                                            lock_timeout=lock_timeout)
+        cr = ctx.env.cr
+        cr.execute("SELECT count(*) FROM pg_stat_activity "
+                   "WHERE datname = current_database() "
+                   "AND wait_event_type = 'Lock'")
+        lock_waiters = cr.fetchone()[0]
+    stats.update(chunk=number, first_row=first_row, rows=rows,
+                 pid=os.getpid(), error=error, retries=attempt,
+                 lock_waiters=lock_waiters)
+    return stats
+
+
+def save_import_step(target, date_start, stats, failed):
+    """ Record the import as a step of the version, in a worker """
+    ctx = process.worker_context()
+    try:
+        with ctx.env.registry.cursor() as cr:
+            steps.save_step(cr, 'importer.py %s' % target, 'import', 0,
+                            date_start, stats, failed)
+    except Exception as err:
+        # the timings must never break an import
+        print('Unable to record the step of the import: %s' % err)
+
+
+class Tuner(object):
+    """ Adjust the chunk size and the number of chunks loaded at the same
+    time from the measures of the loaded chunks
+
+    The measures are taken by windows of as many chunks as there are
+    workers loading:
+
+    * with `adapt_chunk_size`, the chunk size aims at chunks of
+      `chunk_seconds` from the rows/s of a worker: big enough to pay for
+      the commit and the call of the song, small enough to keep the
+      transactions, and the retries, short;
+    * the concurrency climbs one worker at a time while the rows/s of the
+      import grow, and steps back when they do not;
+    * it is halved when the loads contend: retried chunks or sessions
+      waiting for locks.
+    """
+
+    min_chunk_size = 50
+    max_chunk_size = 20000
+    max_retry_rate = 0.05
+    min_gain = 1.05
+
+    def __init__(self, max_workers, chunk_size, chunk_seconds=10.,
+                 adaptive=True, adapt_chunk_size=False):
+        self.max_workers = max_workers
+        self.adaptive = adaptive
+        self.adapt_chunk_size = adaptive and adapt_chunk_size
+        self.workers = max(1, max_workers // 2) if adaptive else max_workers
+        self.chunk_size = chunk_size
+        self.chunk_seconds = chunk_seconds
+        self._step = 1
+        self._last_rate = None
+        self._window = []
+        self._window_start = time.time()
+
+    def update(self, stats):
+        """ Add the measures of a chunk, return a message when the settings
+        change
+        """
+        if not self.adaptive:
+            return None
+        self._window.append(stats)
+        if len(self._window) < self.workers:
+            return None
+        window, self._window = self._window, []
+        elapsed = time.time() - self._window_start
+        self._window_start = time.time()
+        done = [chunk for chunk in window if not chunk['error']]
+        rows = sum(chunk['rows'] for chunk in done)
+        busy = sum(chunk['wall'] for chunk in done)
+        rate = rows / (elapsed or 1e-6)
+        retries = sum(chunk['retries'] for chunk in window)
+        retry_rate = retries / float(len(window) + retries)
+        lock_waiters = max(chunk['lock_waiters'] for chunk in window)
+
+        if self.adapt_chunk_size and rows and busy:
+            target = rows / busy * self.chunk_seconds
+            self.chunk_size = int(min(max(
+                (self.chunk_size + target) / 2, self.min_chunk_size
+            ), self.max_chunk_size))
+
+        if (retry_rate > self.max_retry_rate or
+                lock_waiters >= max(2, self.workers // 2)):
+            workers = max(1, self.workers // 2)
+            self._step = 1
+        else:
+            if (self._last_rate is not None and
+                    rate < self._last_rate * self.min_gain):
+                # the last step did not pay off, go the other way
+                self._step = -self._step
+            workers = min(max(self.workers + self._step, 1),
+                          self.max_workers)
+        self._last_rate = rate
+        self.workers = workers
+        return ('Tuning: %d workers, chunks of %d rows '
+                '(%.0f rows/s, %.0f%% retries, %d sessions waiting for '
+                'locks)' % (workers, self.chunk_size, rate,
+                            retry_rate * 100, lock_waiters))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Import a heavy CSV file in parallel with a song.'
+    )
+    parser.add_argument('target',
+                        help='song to call for each chunk, '
+                             'e.g. songs.install.inventory::setup_locations')
+    parser.add_argument('path',
+                        help='path of the CSV file (can be compressed with '
+                             'gzip or zstd), or of a Parquet or Arrow file')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='maximum number of worker processes '
+                             '(default: number of processors)')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='number of rows of the chunks, of the first '
+                             'ones with --adaptive-chunk-size (default: 500)')
+    parser.add_argument('--no-adaptive', dest='adaptive',
+                        action='store_false',
+                        help='load with all the workers')
+    parser.add_argument('--adaptive-chunk-size', action='store_true',
+                        help='adapt the chunk size to the throughput; the '
+                             'chunks of a failed import are then not skipped '
+                             'by the checkpoints when it is run again')
+    parser.add_argument('--chunk-seconds', type=float, default=10.,
+                        help='duration of a chunk the adaptive chunk size '
+                             'aims at (default: 10)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='number of retries of a chunk failing on a '
+                             'serialization failure, a deadlock or a lock '
+                             'timeout (default: 3)')
+    parser.add_argument('--lock-timeout', type=float, default=10.,
+                        help='seconds a statement waits for a lock before '
+                             'the chunk is retried, 0 to wait forever '
+                             '(default: 10)')
+    parser.add_argument('--stats-file',
+                        help='write a JSON summary of the import in this '
+                             'file')
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    args, odoo_args = parse_args(sys.argv[1:] if argv is None else argv)
+    if not os.path.isfile(args.path):
+        print('Unable to find the data file %s' % args.path,
+              file=sys.stderr)
+        return 1
+
+    started = time.time()
+    path = args.path
+    if formats.sniff_file(path) in formats.COMPRESSED:
+        print('Decompressing %s' % path)
+        path = formats.decompress_to_file(path)
+    try:
+        return run_import(args, odoo_args, path, started)
+    finally:
+        if path != args.path:
+            os.remove(path)
+
+
+def run_import(args, odoo_args, path, started):
+    """ Load the chunks of `path` with a pool of workers
+
+    The pool has `--workers` processes, the `Tuner` decides how many of
+    them load a chunk at the same time and the size of the next chunks.
+    """
+    tuner = Tuner(args.workers, args.chunk_size,
+                  chunk_seconds=args.chunk_seconds, adaptive=args.adaptive,
+                  adapt_chunk_size=args.adaptive_chunk_size)
+    reader = ChunkReader(path)
+    pool = multiprocessing.Pool(args.workers,
+                                initializer=process.init_worker,
+                                initargs=(odoo_args,))
+    results = queue.Queue()
+    running = 0
+    errors = []
+    summary = {'chunks': 0, 'rows': 0, 'sql_count': 0, 'cpu': 0.,
+               'peak_rss': 0, 'retries': 0}
+    try:
+        while True:
+            while running < tuner.workers:
+                chunk = reader.next_chunk(tuner.chunk_size)
+                if chunk is None:
+                    break
+                pool.apply_async(
+                    run_chunk,
+                    ((args.target, path, chunk, args.retries,
+                      args.lock_timeout),),
+                    callback=results.put, error_callback=results.put,
+                )
+                running += 1
+            if not running:
+                break
+            stats = results.get()
+            running -= 1
+            if isinstance(stats, BaseException):
+                raise stats
+            summary['chunks'] += 1
+            summary['rows'] += stats['rows']
+            summary['sql_count'] += stats['sql_count']
+            summary['cpu'] += stats['cpu']
+            summary['retries'] += stats['retries']
+            summary['peak_rss'] = max(summary['peak_rss'], stats['peak_rss'])
+            status = 'failed' if stats['error'] else 'done'
+            if stats['retries']:
+                status += ' after %d retries' % stats['retries']
+            print('Chunk %d (from row %d, %d rows) %s in %.2fs' % (
+                stats['chunk'], stats['first_row'], stats['rows'], status,
+                stats['wall']
+            ))
+            if stats['error']:
+                errors.append(
+                    (stats['chunk'], stats['first_row'], stats['error'])
+                )
+            message = tuner.update(stats)
+            if message:
+                print(message)
+        pool.apply(save_import_step, (
+            args.target, datetime.datetime.utcfromtimestamp(started),
+            dict(summary, wall=time.time() - started), bool(errors),
+        ))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        reader.close()
+
+    elapsed = time.time() - started
+    print('Parallel total loading data: %ds (%d chunks, %d workers, '
+          '%d retries)' % (elapsed, summary['chunks'], args.workers,
+                           summary['retries']))
+    if args.stats_file:
+        summary.update(wall=elapsed, workers=args.workers,
+                       chunk_size=args.chunk_size, errors=len(errors),
+                       final_workers=tuner.workers,
+                       final_chunk_size=tuner.chunk_size,
+                       rows_per_second=summary['rows'] / (elapsed or 1e-6))
+        with open(args.stats_file, 'w') as stats_file:
+            json.dump(summary, stats_file, indent=2)
+    if errors:
+        print('%d chunk(s) failed:' % len(errors), file=sys.stderr)
+        for number, first_row, error in sorted(errors):
+            print('=== Chunk %d (from row %d)\n%s' % (
+                number, first_row, error
+            ), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
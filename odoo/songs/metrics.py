@@ -0,0 +1,65 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Measure what songs and loaders cost """
+
+import json
+import os
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+
+
+def peak_rss():
+    """ Return the peak resident memory of the process, in bytes """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def measure(cr=None):
+    """ Measure the wall time, CPU time, peak RSS and SQL queries of a block
+
+    The statistics are filled in the yielded dict when the block exits::
+
+        with measure(ctx.env.cr) as stats:
+            load_csv_parallel(ctx, 'res.partner', path)
+        ctx.log_line('%(wall).2fs, %(sql_count)d queries' % stats)
+
+    """
+    stats = {}
+    sql_start = cr.sql_log_count if cr is not None else None
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    try:
+        yield stats
+    finally:
+        stats.update({
+            'wall': time.time() - wall_start,
+            'cpu': time.process_time() - cpu_start,
+            'peak_rss': peak_rss(),
+            'sql_count': (cr.sql_log_count - sql_start
+                          if cr is not None else None),
+        })
+
+
+def emit_event(event):
+    """ Write an event as a JSON line in the file of IMPORT_EVENTS
+
+    IMPORT_EVENTS is a path, or `-` for the standard output. Nothing is
+    written when it is not set. Each event is written with a single
+    `write()` in append mode, so the workers of the importer can share the
+    file.
+    """
+    target = os.environ.get('IMPORT_EVENTS')
+    if not target:
+        return
+    line = json.dumps(event, sort_keys=True) + '\n'
+    if target == '-':
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    else:
+        with open(target, 'a') as events:
+            events.write(line)
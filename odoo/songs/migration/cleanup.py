@@ -0,0 +1,295 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Set-based purge of what the uninstalled modules left in the database
+
+The candidates are the ones of the wizards of `database_cleanup` (models,
+columns, tables, metadata and menus), but each category is purged with
+grouped statements rather than one `purge()` per wizard line, and the
+orphan metadata are found and deleted in SQL, per model.
+
+`cleanup_report` lists what would be purged, the size of the tables
+involved and an estimation of the time, without deleting anything.
+"""
+
+import time
+
+from odoo.exceptions import UserError
+
+# The marabunta tables must never be deleted
+PROTECTED_TABLES = (
+    'marabunta_version',
+    'marabunta_import_checkpoint',
+    'marabunta_deferred_compute',
+    'marabunta_check_fields',
+    'marabunta_version_step',
+)
+# Metadata exported, imported or from setup must not be deleted
+PROTECTED_XMLIDS = ('__export__', '__setup__', '__import__')
+
+# Rough costs of the purge of each category, to estimate its duration:
+# (seconds per statement, seconds per item)
+ESTIMATED_COSTS = {
+    'models': (5., 0.5),
+    'columns': (0.1, 0.01),
+    'tables': (0.1, 0.05),
+    'data': (0.05, 0.0001),
+    'menus': (1., 0.01),
+}
+
+CATEGORIES = ('models', 'columns', 'tables', 'data', 'menus')
+
+
+def wizard_candidates(env, wizard):
+    """ Return the values of the lines a `database_cleanup` wizard would
+    create, without creating them
+    """
+    try:
+        return [values for __, __, values in env[wizard].find()]
+    except UserError:
+        # raised by the wizards when there is nothing to purge
+        return []
+
+
+def _protected_condition():
+    condition = ' AND '.join(
+        "strpos(d.module || '.' || d.name, %s) = 0" for __ in PROTECTED_XMLIDS
+    )
+    return condition, list(PROTECTED_XMLIDS)
+
+
+def data_candidates(env):
+    """ Return [(model, table, count)] of the orphan metadata to purge
+
+    The metadata of an unknown model have no table: all of them are
+    orphans. Otherwise, the orphans are the metadata of deleted records.
+    """
+    cr = env.cr
+    protected, params = _protected_condition()
+    cr.execute('SELECT DISTINCT model FROM ir_model_data '
+               'WHERE model IS NOT NULL')
+    candidates = []
+    for model, in cr.fetchall():
+        if model not in env:
+            query = ('SELECT count(*) FROM ir_model_data d '
+                     'WHERE d.model = %s AND ' + protected)
+            table = None
+        elif env[model]._abstract:
+            continue
+        else:
+            table = env[model]._table
+            query = (
+                'SELECT count(*) FROM ir_model_data d '
+                'WHERE d.model = %s AND d.res_id IS NOT NULL '
+                'AND NOT EXISTS (SELECT 1 FROM "{}" t WHERE t.id = d.res_id) '
+                'AND '.format(table) + protected
+            )
+        cr.execute(query, [model] + params)
+        count = cr.fetchone()[0]
+        if count:
+            candidates.append((model, table, count))
+    return candidates
+
+
+def cleanup_candidates(env):
+    """ Return the candidates of the purge, by category """
+    tables = [values['name'] for values
+              in wizard_candidates(env, 'cleanup.purge.wizard.table')
+              if values['name'] not in PROTECTED_TABLES]
+    columns = {}
+    for values in wizard_candidates(env, 'cleanup.purge.wizard.column'):
+        model = env['ir.model'].browse(values['model_id']).model
+        columns.setdefault(env[model]._table, set()).add(values['name'])
+    return {
+        'models': [values['name'] for values
+                   in wizard_candidates(env, 'cleanup.purge.wizard.model')],
+        'columns': columns,
+        'tables': tables,
+        'data': data_candidates(env),
+        'menus': [values['menu_id'] for values
+                  in wizard_candidates(env, 'cleanup.purge.wizard.menu')],
+    }
+
+
+def table_sizes(cr, tables):
+    """ Return {table: total size in bytes} of the existing tables """
+    if not tables:
+        return {}
+    cr.execute(
+        'SELECT relname, pg_total_relation_size(oid) FROM pg_class '
+        "WHERE relkind = 'r' AND relname IN %s", (tuple(tables),)
+    )
+    return dict(cr.fetchall())
+
+
+def estimate(category, statements, items):
+    per_statement, per_item = ESTIMATED_COSTS[category]
+    return statements * per_statement + items * per_item
+
+
+def cleanup_report(ctx, candidates=None):
+    """ Log what the purge would delete, with the sizes of the tables and
+    the estimated durations, return the total estimated seconds
+    """
+    env = ctx.env
+    if candidates is None:
+        candidates = cleanup_candidates(env)
+    models = candidates['models']
+    columns = candidates['columns']
+    tables = candidates['tables']
+    data = candidates['data']
+    menus = candidates['menus']
+    sizes = table_sizes(env.cr, list(columns) + tables + ['ir_model_data'])
+    column_count = sum(len(names) for names in columns.values())
+    data_count = sum(count for __, __, count in data)
+    lines = [
+        ('models', len(models), 0, estimate('models', 1, len(models))),
+        ('columns', column_count,
+         sum(sizes.get(table, 0) for table in columns),
+         estimate('columns', len(columns), column_count)),
+        ('tables', len(tables), sum(sizes.get(table, 0) for table in tables),
+         estimate('tables', 1, len(tables))),
+        ('data', data_count, sizes.get('ir_model_data', 0),
+         estimate('data', len(data), data_count)),
+        ('menus', len(menus), 0, estimate('menus', 1, len(menus))),
+    ]
+    ctx.log_line('%-10s %10s %12s %10s' % ('category', 'count', 'size (MB)',
+                                           'estimated'))
+    for category, count, size, seconds in lines:
+        ctx.log_line('%-10s %10d %12.1f %9.0fs' % (
+            category, count, size / 1024. / 1024., seconds
+        ))
+    for table in tables:
+        ctx.log_line('  table %s: %.1f MB' % (
+            table, sizes.get(table, 0) / 1024. / 1024.
+        ))
+    for model, __, count in sorted(data, key=lambda item: -item[2]):
+        ctx.log_line('  data %s: %d orphans' % (model, count))
+    total = sum(seconds for __, __, __, seconds in lines)
+    ctx.log_line('Estimated total: %.0fs' % total)
+    return total
+
+
+def purge_models(env, models):
+    """ Same steps as the purge of `cleanup.purge.line.model`, for all the
+    models at once
+    """
+    if not models:
+        return
+    flags = {'MODULE_UNINSTALL_FLAG': True, 'no_drop_table': True}
+    models = tuple(models)
+    env.cr.execute('UPDATE ir_attachment SET res_model = NULL '
+                   'WHERE res_model IN %s', (models,))
+    env['ir.model.constraint'].search([
+        ('model.model', 'in', models),
+    ]).unlink()
+    relations = env['ir.model.fields'].search([
+        ('relation', 'in', models),
+    ]).with_context(**flags)
+    try:
+        with env.cr.savepoint():
+            relations.unlink()
+    except (KeyError, AttributeError):
+        # a model on the other side cannot be instantiated: unlink what can
+        # be unlinked, as the wizard does, once the partial unlink is
+        # rolled back
+        env.invalidate_all()
+        for relation in relations:
+            try:
+                with env.cr.savepoint():
+                    relation.unlink()
+            except (KeyError, AttributeError):
+                pass
+    env['ir.model.relation'].search([
+        ('model.model', 'in', models),
+    ]).with_context(**flags).unlink()
+    env['ir.model'].search([
+        ('model', 'in', models),
+    ]).with_context(**flags).unlink()
+
+
+def purge_columns(env, columns):
+    """ Drop the columns with one ALTER TABLE per table """
+    for table, names in sorted(columns.items()):
+        env.cr.execute('ALTER TABLE "{}" {}'.format(table, ', '.join(
+            'DROP COLUMN IF EXISTS "%s"' % name for name in sorted(names)
+        )))
+
+
+def purge_tables(env, tables):
+    """ Drop the tables in one statement
+
+    As the wizard does, the foreign keys between the purged tables are
+    dropped first and the tables are dropped without CASCADE: a table or a
+    view which is kept but depends on them makes the purge fail rather
+    than losing its keys or being dropped.
+    """
+    if not tables:
+        return
+    cr = env.cr
+    tables = tuple(tables)
+    cr.execute("""
+        SELECT c.conname, t.relname FROM pg_constraint c
+        JOIN pg_class t ON t.oid = c.conrelid
+        JOIN pg_class f ON f.oid = c.confrelid
+        WHERE c.contype = 'f' AND t.relname IN %s AND f.relname IN %s
+    """, (tables, tables))
+    for constraint, table in cr.fetchall():
+        cr.execute('ALTER TABLE "{}" DROP CONSTRAINT "{}"'.format(
+            table, constraint
+        ))
+    cr.execute('DROP TABLE IF EXISTS {}'.format(
+        ', '.join('"%s"' % table for table in tables)
+    ))
+
+
+def purge_data(env, data):
+    """ Delete the orphan metadata with one statement per model """
+    protected, params = _protected_condition()
+    unknown = tuple(model for model, table, __ in data if not table)
+    if unknown:
+        env.cr.execute('DELETE FROM ir_model_data d WHERE d.model IN %s '
+                       'AND ' + protected, [unknown] + params)
+    for model, table, __ in data:
+        if table:
+            env.cr.execute(
+                'DELETE FROM ir_model_data d WHERE d.model = %s '
+                'AND d.res_id IS NOT NULL '
+                'AND NOT EXISTS (SELECT 1 FROM "{}" t WHERE t.id = d.res_id) '
+                'AND '.format(table) + protected, [model] + params
+            )
+    env['ir.model.data'].clear_caches()
+
+
+def purge_menus(env, menu_ids):
+    env['ir.ui.menu'].with_context(active_test=False).browse(
+        menu_ids
+    ).unlink()
+
+
+PURGES = {
+    'models': purge_models,
+    'columns': purge_columns,
+    'tables': purge_tables,
+    'data': purge_data,
+    'menus': purge_menus,
+}
+
+
+def bulk_cleanup(ctx, dry_run=False):
+    """ Purge the candidates of each category, committing after each one
+
+    The report of `cleanup_report` is logged first. With `dry_run`, nothing
+    is deleted.
+    """
+    candidates = cleanup_candidates(ctx.env)
+    cleanup_report(ctx, candidates)
+    if dry_run:
+        return
+    for category in CATEGORIES:
+        if not candidates[category]:
+            continue
+        started = time.time()
+        PURGES[category](ctx.env, candidates[category])
+        ctx.env.cr.commit()
+        ctx.log_line('Purged %s in %.1fs' % (category, time.time() - started))
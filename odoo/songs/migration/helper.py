@@ -1,55 +1,118 @@
 # Copyright 2018 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import time
+
 from openupgradelib.openupgrade import logged_query
 
 
 def update_module_moved_models(cr, models, old_module, new_module):
     """ Update metadata for models moved to another module """
+    return update_modules_moved_models(
+        cr, [(model, old_module, new_module) for model in models]
+    )
+
+
+def update_modules_moved_models(cr, moves):
+    """ Update metadata for models moved to other modules
+
+    `moves` is a list of (model, old module, new module). The XML IDs of
+    the models and of their fields are moved in one statement.
+
+    Return {model: {'ir.model': count, 'ir.model.fields': count}}, the
+    number of XML IDs moved per model.
+    """
 
     # TODO: If that function works correctly on many projects,
     # TODO: see to propose it on openupgradelib.
 
-    for model in models:
-        query = 'SELECT id FROM ir_model WHERE name = %s'
-        cr.execute(query, [model])
-        row = cr.fetchone()
-        if row:
-            model_id = row[0]
-
-            # Update the XML ID of the model
-            query = """
-                UPDATE
-                    ir_model_data
-                SET
-                    module = %s
-                WHERE
-                    module = %s
-                AND
-                    model = 'ir.model'
-                AND
-                    res_id = %s
-            """
-            logged_query(cr, query, (new_module, old_module, model_id))
-
-            # Update the XML ID of the fields of the model
-            query = """
-                UPDATE
-                    ir_model_data
-                SET
-                    module = %s
-                WHERE
-                    module = %s
-                AND
-                    model = 'ir.model.fields'
-                AND
-                    res_id IN (
-                        SELECT
-                            id
-                        FROM
-                            ir_model_fields
-                        WHERE
-                            model_id = %s
-                    )
-            """
-            logged_query(cr, query, (new_module, old_module, model_id))
+    counts = {model: {'ir.model': 0, 'ir.model.fields': 0}
+              for model, __, __ in moves}
+    if not moves:
+        return counts
+    query = """
+        WITH moves (model, old_module, new_module) AS (
+            VALUES {values}
+        ), moved AS (
+            SELECT
+                data.id, moves.model, moves.new_module
+            FROM
+                moves
+            JOIN ir_model model ON model.model = moves.model
+            JOIN ir_model_data data ON data.model = 'ir.model'
+                AND data.res_id = model.id
+                AND data.module = moves.old_module
+            UNION ALL
+            SELECT
+                data.id, moves.model, moves.new_module
+            FROM
+                moves
+            JOIN ir_model model ON model.model = moves.model
+            JOIN ir_model_fields field ON field.model_id = model.id
+            JOIN ir_model_data data ON data.model = 'ir.model.fields'
+                AND data.res_id = field.id
+                AND data.module = moves.old_module
+        )
+        UPDATE
+            ir_model_data data
+        SET
+            module = moved.new_module
+        FROM
+            moved
+        WHERE
+            data.id = moved.id
+        RETURNING
+            moved.model, data.model
+    """.format(values=', '.join(['(%s, %s, %s)'] * len(moves)))
+    logged_query(cr, query, [value for move in moves for value in move])
+    for model, data_model in cr.fetchall():
+        counts[model][data_model] += 1
+    return counts
+
+
+def execute_by_id_slices(ctx, statement, table, where, params=None,
+                         batch_size=10000, log_interval=10):
+    """ Execute an UPDATE or DELETE by slices of ids, with a commit per slice
+
+    `statement` is the query without its WHERE clause (e.g.
+    `DELETE FROM ir_attachment`), `where` the condition of the rows to
+    process, which must exclude the rows already processed: an interrupted
+    run restarts where it stopped. The table is walked from the smallest to
+    the biggest id matching `where`, each slice of `batch_size` ids is
+    committed and the progress and the remaining time are logged every
+    `log_interval` seconds.
+
+    Return the number of rows processed.
+    """
+    cr = ctx.env.cr
+    params = dict(params or {})
+    cr.execute('SELECT min(id), max(id) FROM {} WHERE {}'.format(
+        table, where
+    ), params)
+    first_id, last_id = cr.fetchone()
+    if first_id is None:
+        ctx.log_line('Nothing to do on %s' % table)
+        return 0
+    query = '{} WHERE {} AND id >= %(slice_start)s AND id < %(slice_end)s'
+    query = query.format(statement, where)
+    total = last_id - first_id + 1
+    count = 0
+    started = logged = time.time()
+    for slice_start in range(first_id, last_id + 1, batch_size):
+        params.update(slice_start=slice_start,
+                      slice_end=slice_start + batch_size)
+        cr.execute(query, params)
+        count += cr.rowcount
+        cr.commit()
+        done = min(slice_start + batch_size, last_id + 1) - first_id
+        now = time.time()
+        if now - logged >= log_interval or done == total:
+            logged = now
+            elapsed = now - started
+            ctx.log_line(
+                '%s: %d rows, ids %d%% done in %ds, %ds remaining' % (
+                    table, count, done * 100 / total, elapsed,
+                    elapsed * (total - done) / done,
+                )
+            )
+    return count
@@ -4,9 +4,11 @@
 
 import anthem
 from anthem.lyrics.modules import uninstall
-from odoo.modules.module import load_information_from_description_file
+from odoo.modules.module import get_modules
 from odoo.exceptions import UserError
 
+from .cleanup import PROTECTED_TABLES, PROTECTED_XMLIDS, bulk_cleanup
+
 
 @anthem.log
 def uninstall_modules(ctx):
@@ -52,10 +54,8 @@ def database_cleanup(ctx):
     try:
         purge_tables = ctx.env['cleanup.purge.wizard.table'].create({})
         purge_table_lines = purge_tables.purge_line_ids.filtered(
-            lambda l: l.name not in [
-                # The marabunta_version table must never be deleted
-                'marabunta_version',
-            ]
+            # The marabunta tables must never be deleted
+            lambda l: l.name not in PROTECTED_TABLES
         )
         for purge_table_line in purge_table_lines:
             ctx.log_line('Try to purge: %s' % purge_table_line.name)
@@ -69,9 +69,7 @@ def database_cleanup(ctx):
         purge_datas = ctx.env['cleanup.purge.wizard.data'].create({})
         purge_data_lines = purge_datas.purge_line_ids.filtered(
             # Metadata exported, imported or from setup must not be deleted
-            lambda l: '__export__' not in l.name and
-                      '__setup__' not in l.name and
-                      '__import__' not in l.name
+            lambda l: not any(prefix in l.name for prefix in PROTECTED_XMLIDS)
         )
         for purge_data_line in purge_data_lines:
             ctx.log_line('Try to purge: %s' % purge_data_line.name)
@@ -91,6 +89,20 @@ def database_cleanup(ctx):
         ctx.log_line("Cleanup resulted in error: '{}'".format(str(e)))
 
 
+@anthem.log
+def database_cleanup_report(ctx):
+    """ Report what the database cleanup would purge """
+    bulk_cleanup(ctx, dry_run=True)
+
+
+@anthem.log
+def database_cleanup_bulk(ctx):
+    """ Clean database with grouped statements """
+    # Same candidates and exclusions as `database_cleanup`, but each
+    # category is purged at once, see `songs.migration.cleanup`
+    bulk_cleanup(ctx)
+
+
 @anthem.log
 def clean_unavailable_modules(ctx):
     """Clean unavailable modules
@@ -116,27 +128,36 @@ def clean_unavailable_modules(ctx):
         #     ]
         # )
     ])
-    for module in all_modules:
-        info = load_information_from_description_file(module.name)
-        if not info:
-            if module.state in ['uninstalled', 'uninstallable']:
-                ctx.log_line(
-                    'MODULE UNAVAILABLE (will be deleted) : %s' % module.name
-                )
-                if ctx.env['ir.model.data'].search([
-                    ('module', '=', module.name)
-                ]):
-                    ctx.log_line(
-                        "===> CAN'T UNLINK MODULE, WE HAVE METADATA "
-                        "(See if we want to migrate or uninstall the module)"
-                    )
-                else:
-                    module.unlink()
-            else:
+    # index of the modules of the addons path, built once
+    available = set(get_modules())
+    unavailable = all_modules.filtered(lambda m: m.name not in available)
+    bad_state = unavailable.filtered(
+        lambda m: m.state not in ('uninstalled', 'uninstallable')
+    )
+    for module in bad_state:
+        ctx.log_line(
+            'MODULE UNAVAILABLE BUT BAD STATE : %s (%s)' %
+            (module.name, module.state)
+        )
+    to_delete = unavailable - bad_state
+    if to_delete:
+        ctx.env.cr.execute(
+            'SELECT module, count(*) FROM ir_model_data '
+            'WHERE module IN %s GROUP BY module',
+            (tuple(to_delete.mapped('name')),)
+        )
+        with_metadata = dict(ctx.env.cr.fetchall())
+        for module in to_delete:
+            ctx.log_line(
+                'MODULE UNAVAILABLE (will be deleted) : %s' % module.name
+            )
+            if module.name in with_metadata:
                 ctx.log_line(
-                    'MODULE UNAVAILABLE BUT BAD STATE : %s (%s)' %
-                    (module.name, module.state)
+                    "===> CAN'T UNLINK MODULE, WE HAVE METADATA "
+                    "(%d records, see if we want to migrate or uninstall "
+                    "the module)" % with_metadata[module.name]
                 )
+        to_delete.filtered(lambda m: m.name not in with_metadata).unlink()
 
     module_model.update_list()
 
@@ -147,4 +168,7 @@ def post(ctx):
     uninstall_modules(ctx)
     # Check the list of cleaned data before uncomment the call of this function
     # database_cleanup(ctx)
+    # or, for big databases, check the report of `database_cleanup_report`
+    # and use the grouped purge:
+    # database_cleanup_bulk(ctx)
     clean_unavailable_modules(ctx)
@@ -2,9 +2,10 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 import anthem
-import csv
 import os
 
+from .pre_check_fields import CHECK_FIELDS_TABLE, FIELDS_QUERY
+
 
 @anthem.log
 def update_base(ctx):
@@ -24,81 +25,78 @@ def check_fields(ctx):
 
         Compare all fields defined in database between
         the fields before update of modules
+        (saved in `marabunta_check_fields` by `pre_check_fields`)
         and the fields after update of modules.
         To avoid deletion of fields because
         a field has been moved from a module to another.
     """
-    # Get the original fields saved in a CSV file before update of modules
-    original_fields = {}
-    # The explanation for the chosen directory is in the pre_check_fields.py
-    with open('/data/odoo/pre_check_fields.csv', 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        for model_name, module_name, field_name in reader:
-            if model_name not in original_fields:
-                original_fields[model_name] = {}
-            if field_name not in original_fields[model_name]:
-                original_fields[model_name][field_name] = []
-            original_fields[model_name][field_name].append(module_name)
-
-    # Get the final fields we have now in database
-    final_fields = {}
-    ctx.env.cr.execute(
-        """
-SELECT
-    f.model AS model_name,
-    d.module AS module_name,
-    f.name AS field_name
-FROM
-    ir_model_fields f
-INNER JOIN
-    ir_model_data d
-        ON f.id = d.res_id
-        AND d.model = 'ir.model.fields'
-        """
-    )
-    fields_data = ctx.env.cr.fetchall()
-    for model_name, module_name, field_name in fields_data:
-        if model_name not in final_fields:
-            final_fields[model_name] = {}
-        if field_name not in final_fields[model_name]:
-            final_fields[model_name][field_name] = []
-        final_fields[model_name][field_name].append(module_name)
-
-    # For each fields we have now in database,
-    # we will compare the list of modules
-    # which define this field before and after the update of modules.
-    for model_name, model_fields in final_fields.items():
-        for field_name, field_modules in model_fields.items():
-            if field_name in original_fields.get(model_name, {}):
-                original_modules = set(
-                    original_fields[model_name][field_name]
-                )
-                new_modules = set(field_modules)
-                if original_modules and original_modules != new_modules:
-                    # We have not the same list of modules:
-                    # we display a line in build log.
-                    ctx.log_line(
-                        'PROBLEM ON DEFINED FIELD: '
-                        'Model %s / '
-                        'Field %s / '
-                        'Old modules %s / '
-                        'New modules %s' %
-                        (
-                            model_name,
-                            field_name,
-                            list(original_modules),
-                            list(new_modules)
-                        )
-                    )
+    cr = ctx.env.cr
+    cr.execute('SELECT to_regclass(%s)', (CHECK_FIELDS_TABLE,))
+    if not cr.fetchone()[0]:
+        ctx.log_line('No fields saved before the update of modules')
+        return
+    # Only the fields of which the list of modules
+    # has changed are returned by the database
+    cr.execute("""
+        WITH original AS (
+            SELECT
+                model_name,
+                field_name,
+                array_agg(DISTINCT module_name ORDER BY module_name) AS modules
+            FROM {table}
+            GROUP BY model_name, field_name
+        ), final AS (
+            SELECT
+                model_name,
+                field_name,
+                array_agg(DISTINCT module_name ORDER BY module_name) AS modules
+            FROM ({fields}) AS fields
+            GROUP BY model_name, field_name
+        )
+        SELECT
+            coalesce(original.model_name, final.model_name),
+            coalesce(original.field_name, final.field_name),
+            original.modules,
+            final.modules
+        FROM original
+        FULL JOIN final
+            ON final.model_name = original.model_name
+            AND final.field_name = original.field_name
+        WHERE original.modules IS DISTINCT FROM final.modules
+        AND original.modules IS NOT NULL
+        ORDER BY 1, 2
+    """.format(table=CHECK_FIELDS_TABLE, fields=FIELDS_QUERY))
+    for model_name, field_name, original_modules, new_modules in cr.fetchall():
+        if new_modules is None:
+            # The field has been deleted during the update of modules
+            ctx.log_line(
+                'FIELD REMOVED: '
+                'Model %s / '
+                'Field %s / '
+                'Old modules %s' %
+                (model_name, field_name, original_modules)
+            )
+        else:
+            # We have not the same list of modules:
+            # we display a line in build log.
+            ctx.log_line(
+                'PROBLEM ON DEFINED FIELD: '
+                'Model %s / '
+                'Field %s / '
+                'Old modules %s / '
+                'New modules %s' %
+                (model_name, field_name, original_modules, new_modules)
+            )
 
 
 @anthem.log
 def post(ctx):
     """POST: migration check fields"""
     env = os.environ.get('RUNNING_ENV')
-    # We do the check only in dev mode.
-    # To avoid to do the check each times,
-    # the check is done only if it's not disabled in environment variables.
+    # The comparison is done in the database: it is done in every build.
+    # The update of base, which recreates the deleted fields,
+    # is long: it is done only in dev mode,
+    # when it's enabled in environment variables.
     if env == 'dev':
         migration_check_fields = os.environ.get('MIGRATION_CHECK_FIELDS')
         if migration_check_fields != 'True':
@@ -107,4 +105,4 @@ def post(ctx):
             )
         else:
             update_base(ctx)
-            check_fields(ctx)
+    check_fields(ctx)
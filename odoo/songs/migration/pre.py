@@ -4,7 +4,7 @@
 
 import anthem
 import os
-from .helper import update_module_moved_models
+from .helper import execute_by_id_slices, update_modules_moved_models
 from openupgradelib.openupgrade import update_module_names,\
     update_module_moved_fields
 
@@ -13,26 +13,28 @@ from openupgradelib.openupgrade import update_module_names,\
 def fix_path_on_attachments(ctx):
     """ Fix path on attachments """
     env = os.environ.get('RUNNING_ENV')
+    # slices of ids committed one by one, a failed run can be started again
+    batch_size = int(os.environ.get('MIGRATION_BATCH_SIZE', 10000))
     if env in ('prod', 'integration'):
         # Update attachment given by odoo for the database migration
-        ctx.env.cr.execute("""
-    UPDATE
-        ir_attachment
-    SET
-        store_fname = 's3://geo_11-odoo-%s/' || store_fname
-    WHERE
-        store_fname IS NOT NULL
-    AND store_fname NOT LIKE 's3://%%';
-            """ % (env,))
+        execute_by_id_slices(
+            ctx,
+            "UPDATE ir_attachment "
+            "SET store_fname = %(prefix)s || store_fname",
+            'ir_attachment',
+            "store_fname IS NOT NULL AND store_fname NOT LIKE 's3://%%'",
+            params={'prefix': 's3://geo_11-odoo-%s/' % env},
+            batch_size=batch_size,
+        )
     else:
         # Remove the s3 attachment
-        ctx.env.cr.execute("""
-DELETE FROM
-    ir_attachment
-WHERE
-    store_fname IS NOT NULL
-AND store_fname LIKE 's3://%';
-        """)
+        execute_by_id_slices(
+            ctx,
+            "DELETE FROM ir_attachment",
+            'ir_attachment',
+            "store_fname IS NOT NULL AND store_fname LIKE 's3://%%'",
+            batch_size=batch_size,
+        )
 
 
 @anthem.log
@@ -65,17 +67,20 @@ def update_moved_models(ctx):
 
     # Example:
 
-    # update_module_moved_models(
+    # counts = update_modules_moved_models(
     #     ctx.env.cr,
     #     [
     #         # Here we need to list:
     #         # all models which are moved in another module
+    #         # (model, old module, new module)
     #
-    #         'my.custom.model'
+    #         ('my.custom.model', 'old_module', 'new_module'),
     #     ],
-    #     'old_module',  # Old module of the models
-    #     'new_module',  # New module of the models
     # )
+    # for model, moved in sorted(counts.items()):
+    #     ctx.log_line('%s: %d models, %d fields moved' % (
+    #         model, moved['ir.model'], moved['ir.model.fields']
+    #     ))
 
 
 @anthem.log
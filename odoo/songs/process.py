@@ -0,0 +1,118 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Run songs in long-lived worker processes
+
+Each worker of a `multiprocessing` pool initialized with `init_worker`
+loads the Odoo registry and opens its cursor once, then runs as many songs
+or chunks as it is given with the same anthem context.
+"""
+
+import importlib
+import random
+import time
+import traceback
+
+from multiprocessing.util import Finalize
+
+from anthem.cli import Context, Options
+from odoo import api
+from psycopg2 import errorcodes
+
+from .common import clear_xmlid_cache
+
+_context = None
+
+# errors of concurrent transactions: the work can be done again
+RETRY_PGCODES = (
+    errorcodes.SERIALIZATION_FAILURE,
+    errorcodes.DEADLOCK_DETECTED,
+    errorcodes.LOCK_NOT_AVAILABLE,
+)
+# `model.load()` turns the database errors in import messages, which only
+# keep the message of PostgreSQL
+RETRY_MESSAGES = (
+    'could not serialize access',
+    'deadlock detected',
+    'canceling statement due to lock timeout',
+)
+
+
+def import_target(target):
+    """ Return the function of a `songs.module::function` target """
+    module_path, func_name = target.split('::')
+    module = importlib.import_module(module_path)
+    return getattr(module, func_name)
+
+
+def init_worker(odoo_args):
+    """ Initializer of the pool workers: build the anthem context once """
+    global _context
+    _context = Context(odoo_args, Options()).__enter__()
+    Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    global _context
+    if _context is not None:
+        _context.__exit__(None, None, None)
+        _context = None
+
+
+def worker_context():
+    """ Return the anthem context of the current worker """
+    return _context
+
+
+def refresh_environment(ctx):
+    """ Reload the registry of the worker if another process changed it
+    (e.g. a song installed a module) and rebuild the environment of `ctx`
+    """
+    registry = ctx.env.registry
+    if registry.check_signaling() is not registry:
+        env = ctx.env
+        api.Environment.reset()
+        ctx.env = api.Environment(env.cr, env.uid, env.context)
+
+
+def is_retryable(error):
+    """ Return whether an exception is due to a concurrent transaction """
+    if getattr(error, 'pgcode', None) in RETRY_PGCODES:
+        return True
+    return any(message in str(error) for message in RETRY_MESSAGES)
+
+
+def run_target(ctx, target, retries=0, lock_timeout=None):
+    """ Run a song in its own transaction, committed at its end
+
+    A song failing on a concurrent transaction (see `is_retryable`) is
+    rolled back and run again up to `retries` times, after a random and
+    growing delay. With a `lock_timeout` in seconds, a statement waiting
+    longer for a lock fails and the song is retried.
+
+    Return the traceback of the last failure, None if the song is done,
+    and the number of retries.
+    """
+    attempt = 0
+    while True:
+        refresh_environment(ctx)
+        cr = ctx.env.cr
+        try:
+            if lock_timeout is not None:
+                cr.execute('SET lock_timeout = %s',
+                           (int(lock_timeout * 1000),))
+            import_target(target)(ctx)
+            cr.commit()
+            ctx.env.registry.signal_changes()
+            return None, attempt
+        except Exception as exc:
+            cr.rollback()
+            ctx.env.registry.reset_changes()
+            clear_xmlid_cache(ctx)
+            if attempt < retries and is_retryable(exc):
+                attempt += 1
+                time.sleep(random.uniform(0.5, 1) * 2 ** attempt)
+                continue
+            return traceback.format_exc(), attempt
+        finally:
+            ctx.env.invalidate_all()
@@ -0,0 +1,188 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Run songs in parallel along their dependencies
+
+Marabunta runs each `anthem` operation on its own, one after the other,
+and each one loads the Odoo registry. The runner reads a graph of songs
+and runs the songs whose dependencies are done at the same time, with a
+pool of workers which load the registry once (see `songs.process`).
+
+The graph is a YAML file listing the songs and the songs they depend on::
+
+    songs:
+      - song: songs.install.accounting::main
+      - song: songs.install.logistics::main
+      - song: songs.install.data_all::main
+        depends:
+          - songs.install.accounting::main
+          - songs.install.logistics::main
+
+A song starts once all its dependencies are done, the songs ready at the
+same time start in the order of the file. Each song runs in its own
+transaction, committed at its end, and is recorded as a step of the
+version (see `songs.steps`). A song failing on a serialization failure or
+a deadlock with a concurrent song is retried (`--retries`).
+When a song fails otherwise, no other song starts, the running ones finish
+and the command exits with an error.
+
+Usage in `migration.yml`::
+
+    - song_runner.py /odoo/songs/install/songs.yml
+
+Any unknown argument is given to Odoo.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+from collections import OrderedDict
+
+import yaml
+
+from . import process, steps
+from .metrics import measure
+
+
+def load_graph(path):
+    """ Read a graph of songs, return an ordered dict {song: dependencies}
+
+    Raise a `ValueError` for an unknown dependency or a cycle.
+    """
+    with open(path) as graph_file:
+        content = yaml.safe_load(graph_file) or {}
+    graph = OrderedDict()
+    for step in content.get('songs') or []:
+        if isinstance(step, str):
+            step = {'song': step}
+        if step['song'] in graph:
+            raise ValueError('Song %s listed twice' % step['song'])
+        graph[step['song']] = list(step.get('depends') or [])
+    for song, depends in graph.items():
+        unknown = set(depends) - set(graph)
+        if unknown:
+            raise ValueError('Unknown dependencies of %s: %s' % (
+                song, ', '.join(sorted(unknown))
+            ))
+    done = set()
+    while len(done) < len(graph):
+        ready = [song for song, depends in graph.items()
+                 if song not in done and done.issuperset(depends)]
+        if not ready:
+            raise ValueError('Cycle between the songs: %s' % ', '.join(
+                song for song in graph if song not in done
+            ))
+        done.update(ready)
+    return graph
+
+
+def run_song(args):
+    """ Run a song in a worker, return a report of the run """
+    target, retries = args
+    ctx = process.worker_context()
+    with measure(ctx.env.cr) as stats, steps.song_step(ctx, target) as step:
+        with steps.record_songs():
+            error, attempt = process.run_target(ctx, target,
+                                                retries=retries)
+        step['failed'] = bool(error)
+    stats.update(song=target, pid=os.getpid(), error=error, retries=attempt)
+    return stats
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Run a graph of songs in parallel.'
+    )
+    parser.add_argument('graph', help='path of the YAML graph of songs')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='maximum number of worker processes '
+                             '(default: number of processors)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='number of retries of a song failing on a '
+                             'serialization failure or a deadlock '
+                             '(default: 2)')
+    parser.add_argument('--stats-file',
+                        help='write the timings of the songs in JSON in '
+                             'this file')
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    args, odoo_args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        graph = load_graph(args.graph)
+    except (IOError, ValueError) as err:
+        print('Invalid graph %s: %s' % (args.graph, err), file=sys.stderr)
+        return 1
+    if not graph:
+        return 0
+
+    started = time.time()
+    workers = max(1, min(args.workers, len(graph)))
+    pool = multiprocessing.Pool(workers,
+                                initializer=process.init_worker,
+                                initargs=(odoo_args,))
+    results = queue.Queue()
+    pending = OrderedDict(graph)
+    running = set()
+    done = set()
+    errors = []
+    timings = []
+    try:
+        while True:
+            if not errors:
+                for song, depends in list(pending.items()):
+                    if done.issuperset(depends):
+                        del pending[song]
+                        running.add(song)
+                        print('Song %s started' % song)
+                        pool.apply_async(run_song, ((song, args.retries),),
+                                         callback=results.put,
+                                         error_callback=results.put)
+            if not running:
+                break
+            stats = results.get()
+            if isinstance(stats, BaseException):
+                raise stats
+            running.discard(stats['song'])
+            timings.append(stats)
+            status = 'failed' if stats['error'] else 'done'
+            if stats['retries']:
+                status += ' after %d retries' % stats['retries']
+            print('Song %s %s in %.2fs' % (
+                stats['song'], status, stats['wall']
+            ))
+            if stats['error']:
+                errors.append((stats['song'], stats['error']))
+            else:
+                done.add(stats['song'])
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - started
+    print('Songs total: %ds (%d songs, %d workers, %.0fs of songs)' % (
+        elapsed, len(done), workers, sum(stats['wall'] for stats in timings)
+    ))
+    if args.stats_file:
+        with open(args.stats_file, 'w') as stats_file:
+            json.dump({'wall': elapsed, 'workers': workers,
+                       'songs': timings}, stats_file, indent=2)
+    if errors:
+        for song, error in errors:
+            print('=== Song %s\n%s' % (song, error), file=sys.stderr)
+        if pending:
+            print('Songs not run: %s' % ', '.join(pending), file=sys.stderr)
+        return 1
+    return 0
@@ -0,0 +1,243 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Snapshots of the database after the versions of `migration.yml`
+
+When `DB_SNAPSHOT_CACHE` is true, the database and its filestore are saved
+in `DB_SNAPSHOT_DIR` (`/.cachedb/snapshots`, the `data-odoo-db-cache`
+volume) once a migration completed a version. A build on a missing or empty
+database starts from the snapshot of the newest version which is still the
+same, and marabunta runs only the versions after it.
+
+A snapshot of a version is identified by a hash of:
+
+* the marabunta mode;
+* the options of `migration.yml` and the versions up to this one;
+* the content of the songs and of `local-src`;
+* the submodules: `SUBS_MD5` (md5 of `git submodule status`) when it is
+  given, else the size and date of the files of `src` and `external-src`;
+* the size and date of the files of `data`.
+
+Only the versions up to the one of the `VERSION` file are looked up.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tarfile
+
+import yaml
+
+SNAPSHOT_DIR = os.environ.get('DB_SNAPSHOT_DIR', '/.cachedb/snapshots')
+SNAPSHOT_KEEP = int(os.environ.get('DB_SNAPSHOT_KEEP', 5))
+ODOO_DIR = '/odoo'
+FILESTORE_DIR = '/data/odoo/filestore'
+MIGRATION_FILE = os.environ.get('MARABUNTA_MIGRATION_FILE',
+                                os.path.join(ODOO_DIR, 'migration.yml'))
+# versions done when the migration started, written by `restore`
+STATE_FILE = '/tmp/db_snapshot_versions.json'
+
+SKIP_DIRS = ('.git', '__pycache__')
+
+
+def tree_digest(digest, root, content=True):
+    """ Update `digest` with the files of a tree: their content, or their
+    size and date
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames
+                             if name not in SKIP_DIRS)
+        for name in sorted(filenames):
+            if name.endswith('.pyc'):
+                continue
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, root).encode('utf8') + b'\0')
+            if content:
+                with open(path, 'rb') as tree_file:
+                    for block in iter(lambda: tree_file.read(1 << 20), b''):
+                        digest.update(block)
+            else:
+                stat = os.stat(path)
+                digest.update(b'%d %d\0' % (stat.st_size, stat.st_mtime))
+
+
+def base_digest(mode):
+    """ Return a digest of what every version depends on """
+    digest = hashlib.sha1(mode.encode('utf8'))
+    for name in ('songs', 'local-src'):
+        tree_digest(digest, os.path.join(ODOO_DIR, name))
+    subs_md5 = os.environ.get('SUBS_MD5')
+    if subs_md5:
+        digest.update(subs_md5.encode('utf8'))
+    else:
+        for name in ('src', 'external-src'):
+            tree_digest(digest, os.path.join(ODOO_DIR, name), content=False)
+    tree_digest(digest, os.path.join(ODOO_DIR, 'data'), content=False)
+    return digest
+
+
+def version_tuple(number):
+    """ Return a sortable version: `setup` comes first """
+    if number == 'setup':
+        return ()
+    return tuple(int(part) for part in number.split('.'))
+
+
+def snapshot_keys(mode):
+    """ Return [(version, key)] of the versions of `migration.yml` up to
+    the one of the `VERSION` file
+    """
+    with open(MIGRATION_FILE) as migration_file:
+        migration = yaml.safe_load(migration_file)['migration']
+    with open(os.path.join(ODOO_DIR, 'VERSION')) as version_file:
+        ceil = version_tuple(version_file.read().strip())
+    digest = base_digest(mode)
+    digest.update(json.dumps(migration.get('options'),
+                             sort_keys=True).encode('utf8'))
+    keys = []
+    for version in migration['versions']:
+        number = str(version['version'])
+        if version_tuple(number) > ceil:
+            break
+        digest.update(json.dumps(version, sort_keys=True).encode('utf8'))
+        keys.append((number, digest.hexdigest()))
+    return keys
+
+
+def snapshot_path(mode, number, key):
+    """ Return the path of a snapshot, without extension """
+    return os.path.join(SNAPSHOT_DIR, '%s-%s-%s' % (mode, number, key[:16]))
+
+
+def psql(query, dbname=None):
+    """ Run a query, return the rows as lists of strings """
+    output = subprocess.check_output(
+        ['psql', '-tAX', '-c', query, dbname or os.environ['DB_NAME']]
+    ).decode('utf8')
+    return [line.split('|') for line in output.splitlines() if line]
+
+
+def database_exists(dbname):
+    return bool(psql("SELECT 1 FROM pg_database WHERE datname = '%s'" %
+                     dbname, dbname='postgres'))
+
+
+def database_empty(dbname):
+    return not psql("SELECT 1 FROM pg_class c "
+                    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                    "WHERE n.nspname = 'public' LIMIT 1", dbname=dbname)
+
+
+def done_versions(dbname):
+    """ Return {version: date done} of the versions marabunta completed """
+    if not database_exists(dbname):
+        return {}
+    if not psql("SELECT to_regclass('marabunta_version')", dbname)[0][0]:
+        return {}
+    return dict(psql('SELECT number, date_done FROM marabunta_version '
+                     'WHERE date_done IS NOT NULL', dbname))
+
+
+def restore(mode, dbname):
+    """ Restore the newest matching snapshot in a missing or empty database
+
+    Record the versions done in the database before the migration, for
+    `save`.
+    """
+    if not database_exists(dbname) or database_empty(dbname):
+        for number, key in reversed(snapshot_keys(mode)):
+            path = snapshot_path(mode, number, key)
+            if os.path.exists(path + '.pg'):
+                restore_snapshot(path, dbname)
+                print('Database restored from the snapshot of version %s '
+                      '(%s)' % (number, path))
+                break
+        else:
+            print('No database snapshot for this migration')
+    with open(STATE_FILE, 'w') as state_file:
+        json.dump(done_versions(dbname), state_file)
+
+
+def restore_snapshot(path, dbname):
+    if not database_exists(dbname):
+        subprocess.check_call(['createdb', dbname])
+    subprocess.check_call(['pg_restore', '--no-owner', '--jobs',
+                           str(os.cpu_count() or 1), '--dbname', dbname,
+                           path + '.pg'])
+    # a version may have been running when the snapshot was saved
+    psql('DELETE FROM marabunta_version WHERE date_done IS NULL', dbname)
+    if os.path.exists(path + '.tar'):
+        with tarfile.open(path + '.tar') as archive:
+            archive.extractall(os.path.join(FILESTORE_DIR, dbname))
+    os.utime(path + '.pg')
+
+
+def save(mode, dbname):
+    """ Save a snapshot of the database if the migration completed a
+    version and there is no snapshot of it yet
+    """
+    if not os.path.exists(STATE_FILE):
+        print('The migration did not run, no database snapshot')
+        return
+    with open(STATE_FILE) as state_file:
+        before = json.load(state_file)
+    done = done_versions(dbname)
+    if all(before.get(number) == date for number, date in done.items()):
+        return
+    if psql('SELECT 1 FROM marabunta_version WHERE date_done IS NULL',
+            dbname):
+        return
+    last = None
+    for number, key in snapshot_keys(mode):
+        if number not in done:
+            break
+        last = (number, key)
+    if last is None:
+        return
+    path = snapshot_path(mode, *last)
+    if os.path.exists(path + '.pg'):
+        return
+    if not os.path.isdir(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR)
+    subprocess.check_call(['pg_dump', '--format=c', '--compress=1',
+                           '--file', path + '.pg.tmp', dbname])
+    filestore = os.path.join(FILESTORE_DIR, dbname)
+    if os.path.isdir(filestore):
+        with tarfile.open(path + '.tar.tmp', 'w') as archive:
+            archive.add(filestore, arcname='.')
+        os.rename(path + '.tar.tmp', path + '.tar')
+    # the dump is renamed last: a snapshot is complete when it exists
+    os.rename(path + '.pg.tmp', path + '.pg')
+    print('Database snapshot of version %s saved (%s)' % (last[0], path))
+    prune()
+
+
+def prune():
+    """ Keep the `DB_SNAPSHOT_KEEP` snapshots restored or saved last """
+    dumps = sorted(
+        (os.path.join(SNAPSHOT_DIR, name) for name in os.listdir(SNAPSHOT_DIR)
+         if name.endswith('.pg')),
+        key=os.path.getmtime, reverse=True,
+    )
+    for dump in dumps[SNAPSHOT_KEEP:]:
+        for path in (dump, dump[:-len('.pg')] + '.tar'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1 or argv[0] not in ('restore', 'save'):
+        print('Usage: db_snapshot.py restore|save', file=sys.stderr)
+        return 1
+    mode = os.environ.get('MARABUNTA_MODE') or 'default'
+    dbname = os.environ['DB_NAME']
+    if argv[0] == 'restore':
+        restore(mode, dbname)
+    else:
+        save(mode, dbname)
+    return 0
@@ -0,0 +1,223 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Record what each step of a version costs
+
+The steps are recorded in the table `marabunta_version_step` with their
+wall time, CPU time, peak RSS and number of SQL queries, for the marabunta
+version being installed:
+
+* the songs run by `anthem_step.py` (see `run_song`) or by
+  `song_runner.py`, and the songs they call decorated with `@anthem.log`
+  (see `record_songs`) or `@steps.log`;
+* the imports of `importer.py`;
+* the runs of Odoo through `odoo_step.py` (addons installation or upgrade).
+
+The steps are written with their own cursor, so the failed steps are
+recorded too. The camptocamp_tools module shows them on
+`/web/camptocamp/tools/versions`.
+"""
+
+import datetime
+import functools
+import sys
+
+from contextlib import contextmanager
+
+import anthem
+
+from .common import ensure_table
+from .metrics import measure
+
+STEP_TABLE = 'marabunta_version_step'
+STEP_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id serial PRIMARY KEY,
+        version varchar,
+        name varchar,
+        kind varchar,
+        depth integer,
+        date_start timestamp without time zone,
+        wall double precision,
+        cpu double precision,
+        peak_rss bigint,
+        sql_count integer,
+        failed boolean
+    )
+"""
+
+# `anthem.log`, replaced by `log` in `record_songs()`
+_anthem_log = anthem.log
+
+# names of the running steps, the songs call other songs
+_running = []
+
+
+def current_version(cr):
+    """ Return the marabunta version being installed, if any """
+    cr.execute("SELECT to_regclass('marabunta_version')")
+    if not cr.fetchone()[0]:
+        return None
+    cr.execute('SELECT number FROM marabunta_version '
+               'WHERE date_done IS NULL ORDER BY date_start DESC LIMIT 1')
+    row = cr.fetchone()
+    return row[0] if row else None
+
+
+def save_step(cr, name, kind, depth, date_start, stats, failed):
+    ensure_table(cr, STEP_TABLE, STEP_DDL)
+    cr.execute(
+        'INSERT INTO {} (version, name, kind, depth, date_start, wall, cpu, '
+        'peak_rss, sql_count, failed) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'.format(STEP_TABLE),
+        (current_version(cr), name, kind, depth, date_start, stats['wall'],
+         stats['cpu'], stats['peak_rss'], stats['sql_count'], failed)
+    )
+
+
+@contextmanager
+def song_step(ctx, name):
+    """ Measure a song and record it as a step
+
+    The step fails when the block raises or sets `failed` in the yielded
+    dict.
+    """
+    date_start = datetime.datetime.utcnow()
+    step = {'failed': False}
+    depth = len(_running)
+    _running.append(name)
+    try:
+        with measure(ctx.env.cr) as stats:
+            yield step
+    except Exception:
+        step['failed'] = True
+        raise
+    finally:
+        _running.pop()
+        try:
+            with ctx.env.registry.cursor() as cr:
+                save_step(cr, name, 'song', depth, date_start, stats,
+                          step['failed'])
+        except Exception as err:
+            # the timings must never break a song
+            ctx.log_line('Unable to record the step %s: %s' % (name, err))
+
+
+def log(func=None, **kwargs):
+    """ `anthem.log` which also records the song as a step
+
+    For the songs called by another song, to see their share of it::
+
+        from songs import steps
+
+        @steps.log
+        def setup_locations(ctx):
+            ...
+
+    """
+    if func is None:
+        return functools.partial(log, **kwargs)
+    decorated = _anthem_log(func, **kwargs)
+    name = '%s::%s' % (func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def recorded(ctx, *args, **kw):
+        if _running and _running[-1] == name:
+            # the song run by the runner, already recorded
+            return decorated(ctx, *args, **kw)
+        with song_step(ctx, name):
+            return decorated(ctx, *args, **kw)
+    return recorded
+
+
+@contextmanager
+def record_songs():
+    """ Record the songs decorated with `@anthem.log` as steps
+
+    `anthem.log` is `log` in the block: the songs of the modules imported
+    in the block (the runners import their target in it) are recorded
+    without being changed.
+    """
+    anthem.log = log
+    try:
+        yield
+    finally:
+        anthem.log = _anthem_log
+
+
+def run_song(argv):
+    """ Run a song like `anthem` does, record it as a step
+
+    Used in `migration.yml` instead of `anthem`, through `anthem_step.py`.
+    """
+    from anthem.cli import Context, Options
+    from .process import import_target
+
+    target, odoo_args = argv[0], argv[1:]
+    with Context(odoo_args, Options()) as ctx:
+        with song_step(ctx, target), record_songs():
+            try:
+                import_target(target)(ctx)
+            except Exception:
+                ctx.env.cr.rollback()
+                raise
+            ctx.env.cr.commit()
+    return 0
+
+
+def odoo_step_name(args):
+    """ Return the name of the step of an Odoo command: the addons it
+    installs or upgrades
+    """
+    names = []
+    options = {'-i': 'install', '--init': 'install',
+               '-u': 'upgrade', '--update': 'upgrade'}
+    for idx, arg in enumerate(args):
+        option, __, value = arg.partition('=')
+        if option in options:
+            if not value and idx + 1 < len(args):
+                value = args[idx + 1]
+            names.append('%s %s' % (options[option], value))
+    return ', '.join(names) or 'odoo'
+
+
+def run_odoo(args):
+    """ Run Odoo with `args` in this process, record it as a step
+
+    Used as `install_command` of marabunta, through `odoo_step.py`. Odoo
+    exits with its return code, the step fails when it is not 0.
+    """
+    import odoo
+    import odoo.cli
+
+    counter = [0]
+    execute = odoo.sql_db.Cursor.execute
+
+    def counted_execute(self, *args, **kwargs):
+        counter[0] += 1
+        return execute(self, *args, **kwargs)
+
+    odoo.sql_db.Cursor.execute = counted_execute
+    sys.argv = ['odoo'] + list(args)
+    date_start = datetime.datetime.utcnow()
+    failed = True
+    try:
+        with measure() as stats:
+            odoo.cli.main()
+        failed = False
+    except SystemExit as err:
+        failed = bool(err.code)
+        raise
+    finally:
+        odoo.sql_db.Cursor.execute = execute
+        stats['sql_count'] = counter[0]
+        dbname = odoo.tools.config['db_name']
+        try:
+            if dbname:
+                with odoo.sql_db.db_connect(dbname).cursor() as cr:
+                    save_step(cr, odoo_step_name(args), 'addons', 0,
+                              date_start, stats, failed)
+        except Exception as err:
+            # the timings must never change the result of the upgrade
+            print('Unable to record the step: %s' % err, file=sys.stderr)
+    return 0
@@ -0,0 +1,372 @@
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+""" Move the content of the attachments between storages
+
+The storages are the filestore (`file`), the database (`db`) and an S3
+compatible object storage (`s3`, requires `boto3`). The S3 endpoint,
+bucket and credentials are the ones of `attachment_s3`: `AWS_HOST`,
+`AWS_BUCKETNAME`, `AWS_ACCESS_KEY_ID` and `AWS_SECRET_ACCESS_KEY`, so a
+local stand-in (e.g. minio) can replace the object storage.
+
+The attachments are moved by batches of ids by a pool of workers, each
+with its own connection. A batch is moved in its own transaction, which
+locks its attachments, so Odoo keeps running during the move:
+
+* the attachments sharing a checksum are read and written once;
+* the content is checked against the checksum of the attachment;
+* a content already in the target storage is not written again;
+* the attachments moved no longer match the source storage, so running
+  the command again resumes the move.
+
+`--max-rate` throttles the reads and writes of the workers, in MB/s. With
+`--set-location`, `ir_attachment.location` is set to the target storage
+before the move, so the new attachments are stored there. With
+`--delete-source`, the files and objects of the source storage no longer
+referenced by an attachment are deleted.
+
+Usage::
+
+    attachment_mover.py file s3 --workers 8 --max-rate 50
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import OrderedDict
+
+import psycopg2
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+FILESTORE_DIR = '/data/odoo/filestore'
+
+
+def checksum_fname(checksum):
+    """ Return the name of a content in the filestore, as Odoo does """
+    return '%s/%s' % (checksum[:2], checksum)
+
+
+class FileStorage(object):
+
+    location = 'file'
+    condition = "store_fname IS NOT NULL AND store_fname NOT LIKE '%%://%%'"
+
+    def __init__(self, args):
+        self.root = args.filestore
+
+    def read(self, cr, row):
+        with open(os.path.join(self.root, row['store_fname']), 'rb') as data:
+            return data.read()
+
+    def write(self, checksum, content):
+        """ Store a content, return the values of the attachments and
+        whether it was written
+        """
+        fname = checksum_fname(checksum)
+        path = os.path.join(self.root, fname)
+        values = {'store_fname': fname, 'db_datas': None}
+        if os.path.exists(path):
+            return values, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as data:
+            data.write(content)
+        os.rename(path + '.tmp', path)
+        return values, True
+
+    def delete(self, fname):
+        path = os.path.join(self.root, fname)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class DbStorage(object):
+
+    location = 'db'
+    condition = 'store_fname IS NULL AND db_datas IS NOT NULL'
+
+    def __init__(self, args):
+        pass
+
+    def read(self, cr, row):
+        # Odoo keeps the content in base64 in the database
+        cr.execute('SELECT db_datas FROM ir_attachment WHERE id = %s',
+                   (row['id'],))
+        return base64.b64decode(bytes(cr.fetchone()[0]))
+
+    def write(self, checksum, content):
+        values = {'store_fname': None,
+                  'db_datas': psycopg2.Binary(base64.b64encode(content))}
+        return values, True
+
+    def delete(self, fname):
+        pass
+
+
+class S3Storage(object):
+
+    location = 's3'
+    condition = "store_fname LIKE 's3://%%'"
+
+    def __init__(self, args):
+        if boto3 is None:
+            raise SystemExit('The `boto3` package is required to move the '
+                             'attachments from or to S3')
+        self.bucket = args.bucket
+        self.client = boto3.client('s3', endpoint_url=args.endpoint_url)
+
+    @staticmethod
+    def split(store_fname):
+        bucket, __, key = store_fname[len('s3://'):].partition('/')
+        return bucket, key
+
+    def read(self, cr, row):
+        bucket, key = self.split(row['store_fname'])
+        return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def write(self, checksum, content):
+        key = checksum_fname(checksum)
+        values = {'store_fname': 's3://%s/%s' % (self.bucket, key),
+                  'db_datas': None}
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return values, False
+        except ClientError as err:
+            if err.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=content)
+        return values, True
+
+    def delete(self, fname):
+        bucket, key = self.split(fname)
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+
+STORAGES = OrderedDict([
+    ('file', FileStorage),
+    ('db', DbStorage),
+    ('s3', S3Storage),
+])
+
+_mover = None
+
+
+class Mover(object):
+    """ Move batches of attachments in a worker """
+
+    def __init__(self, args):
+        self.conn = psycopg2.connect(dbname=args.database)
+        self.source = STORAGES[args.source](args)
+        self.target = STORAGES[args.target](args)
+        self.delete_source = args.delete_source
+        # bytes per second of this worker
+        self.rate = (args.max_rate * 1024 * 1024 / args.workers
+                     if args.max_rate else None)
+        self.started = time.time()
+        self.moved_bytes = 0
+
+    def throttle(self, size):
+        self.moved_bytes += size
+        if self.rate:
+            late = (self.moved_bytes / self.rate -
+                    (time.time() - self.started))
+            if late > 0:
+                time.sleep(late)
+
+    def move(self, ids):
+        """ Move the attachments of `ids` still in the source storage,
+        return the statistics of the batch
+        """
+        started = time.time()
+        stats = {'first_id': ids[0], 'attachments': 0, 'contents': 0,
+                 'written': 0, 'bytes': 0, 'errors': []}
+        released = set()
+        with self.conn.cursor() as cr:
+            cr.execute(
+                'SELECT id, store_fname, checksum FROM ir_attachment '
+                'WHERE id IN %s AND ' + self.source.condition +
+                ' ORDER BY id FOR UPDATE SKIP LOCKED', (tuple(ids),)
+            )
+            contents = OrderedDict()
+            for row in cr.fetchall():
+                row = dict(zip(('id', 'store_fname', 'checksum'), row))
+                key = row['checksum'] or ('id', row['id'])
+                contents.setdefault(key, []).append(row)
+            for rows in contents.values():
+                try:
+                    content = self.source.read(cr, rows[0])
+                    checksum = hashlib.sha1(content).hexdigest()
+                    if rows[0]['checksum'] not in (None, checksum):
+                        raise ValueError('checksum %s instead of %s' % (
+                            checksum, rows[0]['checksum']
+                        ))
+                    values, written = self.target.write(checksum, content)
+                except Exception as err:
+                    stats['errors'].append(
+                        ([row['id'] for row in rows], repr(err))
+                    )
+                    continue
+                cr.execute(
+                    'UPDATE ir_attachment SET store_fname = %s, '
+                    'db_datas = %s, checksum = %s WHERE id IN %s',
+                    (values['store_fname'], values['db_datas'], checksum,
+                     tuple(row['id'] for row in rows))
+                )
+                released.update(row['store_fname'] for row in rows
+                                if row['store_fname'])
+                stats['attachments'] += len(rows)
+                stats['contents'] += 1
+                stats['written'] += written
+                stats['bytes'] += len(content)
+                self.throttle(len(content))
+            self.conn.commit()
+            if self.delete_source and released:
+                cr.execute('SELECT store_fname FROM ir_attachment '
+                           'WHERE store_fname IN %s', (tuple(released),))
+                for fname in released - {fname for fname, in cr.fetchall()}:
+                    self.source.delete(fname)
+                self.conn.rollback()
+        stats['wall'] = time.time() - started
+        return stats
+
+
+def init_worker(args):
+    global _mover
+    _mover = Mover(args)
+
+
+def move_batch(ids):
+    return _mover.move(ids)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Move the content of the attachments between storages.'
+    )
+    parser.add_argument('source', choices=list(STORAGES),
+                        help='storage the attachments are moved from')
+    parser.add_argument('target', choices=list(STORAGES),
+                        help='storage the attachments are moved to')
+    parser.add_argument('--database', default=os.environ.get('DB_NAME'),
+                        help='database (default: DB_NAME)')
+    parser.add_argument('--filestore',
+                        help='path of the filestore of the database '
+                             '(default: %s/<database>)' % FILESTORE_DIR)
+    parser.add_argument('--bucket', default=os.environ.get('AWS_BUCKETNAME'),
+                        help='S3 bucket (default: AWS_BUCKETNAME)')
+    parser.add_argument('--endpoint-url', default=os.environ.get('AWS_HOST'),
+                        help='S3 endpoint (default: AWS_HOST)')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes '
+                             '(default: number of processors)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='number of attachments moved per transaction '
+                             '(default: 100)')
+    parser.add_argument('--max-rate', type=float,
+                        help='maximum throughput of all the workers, in MB/s')
+    parser.add_argument('--limit', type=int,
+                        help='move at most this number of attachments')
+    parser.add_argument('--set-location', action='store_true',
+                        help='store the new attachments in the target '
+                             'storage (ir_attachment.location)')
+    parser.add_argument('--delete-source', action='store_true',
+                        help='delete the files or objects of the source '
+                             'storage no longer used')
+    parser.add_argument('--stats-file',
+                        help='write a summary of the move in JSON in this '
+                             'file')
+    args = parser.parse_args(argv)
+    if args.source == args.target:
+        parser.error('the source and the target storages are the same')
+    if not args.database:
+        parser.error('no database given')
+    if 's3' in (args.source, args.target) and not args.bucket:
+        parser.error('no S3 bucket given')
+    if not args.filestore:
+        args.filestore = os.path.join(FILESTORE_DIR, args.database)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    source = STORAGES[args.source]
+    conn = psycopg2.connect(dbname=args.database)
+    with conn.cursor() as cr:
+        if args.set_location:
+            cr.execute("UPDATE ir_config_parameter SET value = %s "
+                       "WHERE key = 'ir_attachment.location'",
+                       (STORAGES[args.target].location,))
+            if not cr.rowcount:
+                cr.execute("INSERT INTO ir_config_parameter (key, value) "
+                           "VALUES ('ir_attachment.location', %s)",
+                           (STORAGES[args.target].location,))
+            conn.commit()
+        cr.execute("SELECT id, coalesce(file_size, 0) FROM ir_attachment "
+                   "WHERE type = 'binary' AND " + source.condition +
+                   " ORDER BY id LIMIT %s", (args.limit,))
+        rows = cr.fetchall()
+    conn.close()
+    total_bytes = sum(size for __, size in rows)
+    print('%d attachments (%.1f MB) to move from %s to %s' % (
+        len(rows), total_bytes / 1024. / 1024., args.source, args.target
+    ))
+    if not rows:
+        return 0
+
+    started = time.time()
+    batches = [[row_id for row_id, __ in rows[idx:idx + args.batch_size]]
+               for idx in range(0, len(rows), args.batch_size)]
+    summary = {'attachments': 0, 'contents': 0, 'written': 0, 'bytes': 0}
+    errors = []
+    pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                initargs=(args,))
+    try:
+        for done, stats in enumerate(
+                pool.imap_unordered(move_batch, batches), 1):
+            for key in summary:
+                summary[key] += stats[key]
+            errors += stats['errors']
+            rate = summary['bytes'] / (time.time() - started or 1e-6)
+            remaining = max(total_bytes - summary['bytes'], 0) / (rate or 1.)
+            print('Batch %d/%d: %d attachments moved, %.1f MB/s, '
+                  'remaining %ds' % (done, len(batches),
+                                     summary['attachments'],
+                                     rate / 1024. / 1024., remaining))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - started
+    summary.update(wall=elapsed, workers=args.workers, errors=len(errors),
+                   bytes_per_second=summary['bytes'] / (elapsed or 1e-6))
+    print('Moved %(attachments)d attachments, %(contents)d contents '
+          '(%(written)d written) in %(wall)ds, %(errors)d errors' % summary)
+    print('Throughput: %.1f MB/s' % (
+        summary['bytes_per_second'] / 1024. / 1024.
+    ))
+    if args.stats_file:
+        with open(args.stats_file, 'w') as stats_file:
+            json.dump(summary, stats_file, indent=2)
+    if errors:
+        for ids, error in errors:
+            print('=== Attachments %s: %s' % (
+                ', '.join(str(row_id) for row_id in ids), error
+            ), file=sys.stderr)
+        return 1
+    return 0
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+from __future__ import print_function
+
+import csv
+import json
+import os
+import random
+
+from datetime import datetime
+
+from invoke import task
+
+from .common import build_path, current_version, exit_msg
+
+DATA_DIR = build_path('odoo/data/benchmark')
+# path of DATA_DIR in the odoo container and in the songs project
+CONTAINER_DATA_DIR = '/odoo/data/benchmark'
+SONGS_DATA_DIR = 'data/benchmark'
+TEMPLATE_DB = 'benchmark_template'
+SCRATCH_DB = 'benchmark'
+STATS_FILE = 'stats.json'
+IMPORTER_STATS_FILE = 'importer_stats.json'
+
+LOADERS = ('load_csv', 'batched', 'parallel', 'copy')
+
+STREETS = ('Maidstone Road', 'Station Road', 'Church Lane', 'Park Avenue',
+           'Mill Street', 'High Street', 'Victoria Road', 'Green Lane')
+CITIES = ('WEMBLEY', 'LONDON', 'BRIGHTON', 'LEEDS', 'YORK', 'BATH')
+NAMES = ('Berilac', 'Frodo', 'Rosie', 'Hamfast', 'Lobelia', 'Merimac',
+         'Sackville', 'Baggins', 'Gamgee', 'Proudfoot', 'Bolger', 'Took')
+
+
+def generate_customers(path, rows, rand):
+    """ res.partner rows shaped like data/sample/customers.csv """
+    with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['id', 'name', 'street', 'zip', 'city'])
+        for idx in range(1, rows + 1):
+            writer.writerow([
+                '__benchmark__.customer_%07d' % idx,
+                '%s %s' % (rand.choice(NAMES), rand.choice(NAMES)),
+                '%d %s' % (rand.randint(1, 200), rand.choice(STREETS)),
+                'HA%d %dNU' % (rand.randint(0, 9), rand.randint(1, 9)),
+                rand.choice(CITIES),
+            ])
+
+
+def generate_locations(path, rows, rand, fanout=10):
+    """ stock.location rows: a tree of `fanout` children per location """
+    with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['id', 'name', 'location_id/id', 'usage'])
+        for idx in range(1, rows + 1):
+            parent_idx = (idx - 1) // fanout
+            if parent_idx:
+                parent = '__benchmark__.location_%07d' % parent_idx
+            else:
+                parent = 'stock.stock_location_locations'
+            writer.writerow([
+                '__benchmark__.location_%07d' % idx,
+                'L%07d' % idx,
+                parent,
+                'internal' if rand.random() > 0.1 else 'view',
+            ])
+
+
+DATASETS = {
+    'customers': ('res.partner', generate_customers),
+    'locations': ('stock.location', generate_locations),
+}
+# the COPY path cannot load records referencing records of the same file
+UNSUPPORTED = {('locations', 'copy')}
+
+
+def dataset_path(dataset, rows, base=DATA_DIR):
+    return os.path.join(base, '%s_%d.csv' % (dataset, rows))
+
+
+@task
+def generate(ctx, datasets='customers,locations', sizes='1000,100000,1000000',
+             seed=42):
+    """ Generate the synthetic CSV files of the benchmark
+
+    The files are written in odoo/data/benchmark, they are generated only
+    once for a given dataset and size.
+    """
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    for dataset in datasets.split(','):
+        __, generator = DATASETS[dataset]
+        for rows in [int(size) for size in sizes.split(',')]:
+            path = dataset_path(dataset, rows)
+            if os.path.exists(path):
+                continue
+            print('Generating %s' % path)
+            generator(path, rows, random.Random(seed))
+
+
+def compose_run(ctx, command, db=None, env=None, **kwargs):
+    """ Run a command in a new odoo container, without migration """
+    env = dict(env or {}, MIGRATE='False', PGPASSWORD='odoo')
+    if db:
+        env['DB_NAME'] = db
+    env_args = ' '.join('-e %s=%s' % item for item in sorted(env.items()))
+    return ctx.run('docker-compose run --rm %s odoo %s' % (env_args, command),
+                   **kwargs)
+
+
+def create_template(ctx):
+    compose_run(ctx, 'dropdb --if-exists -U odoo -h db %s' % TEMPLATE_DB)
+    compose_run(ctx, 'odoo --stop-after-init --without-demo=all -i stock',
+                db=TEMPLATE_DB)
+
+
+def reset_scratch_db(ctx):
+    compose_run(ctx, 'dropdb --if-exists -U odoo -h db %s' % SCRATCH_DB)
+    compose_run(ctx, 'createdb -U odoo -h db -T %s %s' % (
+        TEMPLATE_DB, SCRATCH_DB
+    ))
+
+
+def read_stats(name):
+    path = os.path.join(DATA_DIR, name)
+    with open(path) as stats_file:
+        stats = json.load(stats_file)
+    os.remove(path)
+    return stats
+
+
+def run_loader(ctx, loader, model, path):
+    env = {
+        'BENCHMARK_MODEL': model,
+        'BENCHMARK_PATH': path.replace(DATA_DIR, SONGS_DATA_DIR),
+        'BENCHMARK_STATS': os.path.join(CONTAINER_DATA_DIR, STATS_FILE),
+    }
+    if loader != 'parallel':
+        compose_run(ctx, 'anthem songs.benchmark::run_%s' % loader,
+                    db=SCRATCH_DB, env=env)
+        return read_stats(STATS_FILE)
+
+    compose_run(
+        ctx,
+        'importer.py songs.benchmark::load_parallel %s --stats-file %s' % (
+            path.replace(DATA_DIR, CONTAINER_DATA_DIR),
+            os.path.join(CONTAINER_DATA_DIR, IMPORTER_STATS_FILE),
+        ),
+        db=SCRATCH_DB, env=env,
+    )
+    stats = read_stats(IMPORTER_STATS_FILE)
+    # second phase: links to the parents
+    compose_run(ctx, 'anthem songs.benchmark::run_link_parallel',
+                db=SCRATCH_DB, env=env)
+    link_stats = read_stats(STATS_FILE)
+    return {
+        'wall': stats['wall'] + link_stats['wall'],
+        'sql_count': stats['sql_count'] + link_stats['sql_count'],
+        'peak_rss': max(stats['peak_rss'], link_stats['peak_rss']),
+        'workers': stats['workers'],
+    }
+
+
+@task(name='run')
+def run(ctx, datasets='customers,locations', sizes='1000,100000',
+        loaders=','.join(LOADERS), output='benchmark-results.json',
+        reuse_template=False):
+    """ Benchmark the CSV loaders against a scratch database
+
+    For each dataset, size and loader, a database is created from a
+    template database with `stock` installed, the generated file is loaded
+    and the rows/s, peak RSS and SQL queries are recorded in `output`
+    (JSON), with the version of the project, to compare releases.
+
+    Example:
+
+        $ invoke benchmark.run --sizes 1000,100000,1000000 --loaders copy
+
+    """
+    for loader in loaders.split(','):
+        if loader not in LOADERS:
+            exit_msg('Unknown loader %s, choose among %s' % (
+                loader, ', '.join(LOADERS)
+            ))
+    generate(ctx, datasets=datasets, sizes=sizes)
+    if not reuse_template:
+        create_template(ctx)
+
+    results = []
+    for dataset in datasets.split(','):
+        model, __ = DATASETS[dataset]
+        for rows in [int(size) for size in sizes.split(',')]:
+            for loader in loaders.split(','):
+                if (dataset, loader) in UNSUPPORTED:
+                    continue
+                print('Benchmark: %s rows of %s with %s' % (
+                    rows, dataset, loader
+                ))
+                reset_scratch_db(ctx)
+                stats = run_loader(ctx, loader, model,
+                                   dataset_path(dataset, rows))
+                stats.update(dataset=dataset, model=model, rows=rows,
+                             loader=loader,
+                             rows_per_second=rows / (stats['wall'] or 1e-6))
+                print('%(rows_per_second).0f rows/s, %(sql_count)s queries, '
+                      'peak RSS %(peak_rss)s bytes' % stats)
+                results.append(stats)
+
+    commit = ctx.run('git rev-parse HEAD', hide=True, warn=True)
+    with open(output, 'w') as output_file:
+        json.dump({
+            'version': current_version(),
+            'commit': commit.stdout.strip() if commit.ok else None,
+            'date': datetime.now().isoformat(),
+            'results': results,
+        }, output_file, indent=2)
+    print('Results written in %s' % output)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+from __future__ import print_function
+
+import json
+
+from collections import defaultdict
+
+from invoke import task
+
+from .common import exit_msg
+
+
+def percentile(values, rank):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return 0
+    idx = max(0, int(round(rank / 100. * len(values))) - 1)
+    return values[min(idx, len(values) - 1)]
+
+
+def read_events(path):
+    with open(path) as events_file:
+        for line in events_file:
+            line = line.strip()
+            if line.startswith('{'):
+                yield json.loads(line)
+
+
+@task
+def stats(ctx, path, top=10):
+    """ Summarize the chunk events written by the loaders
+
+    Run the import with `IMPORT_EVENTS=/path/to/events.jsonl` (or `-` to
+    get them on the standard output), then:
+
+        $ invoke importer.stats /path/to/events.jsonl
+
+    Prints, per model, the percentiles of the wall time and rows/s of the
+    chunks, the slowest chunks and the rows loaded by each worker.
+    """
+    by_model = defaultdict(list)
+    for event in read_events(path):
+        by_model[event['model']].append(event)
+    if not by_model:
+        exit_msg('No event found in %s' % path)
+
+    for model, events in sorted(by_model.items()):
+        walls = sorted(event['wall'] for event in events)
+        speeds = sorted(event['rows_per_second'] for event in events)
+        print('=== %s: %d chunks, %d rows, %d errors, %d queries' % (
+            model, len(events), sum(event['rows'] for event in events),
+            sum(event['errors'] for event in events),
+            sum(event['sql_count'] or 0 for event in events),
+        ))
+        print('{:<10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            '', 'p50', 'p90', 'p95', 'p99', 'max'))
+        for name, values, fmt in (('wall (s)', walls, '{:>10.2f}'),
+                                  ('rows/s', speeds, '{:>10.0f}')):
+            print('{:<10}'.format(name) + ''.join(
+                fmt.format(percentile(values, rank))
+                for rank in (50, 90, 95, 99, 100)
+            ))
+
+        print('Slowest chunks:')
+        for event in sorted(events, key=lambda e: e['wall'],
+                            reverse=True)[:int(top)]:
+            print('  %(chunk)-20s %(wall)8.2fs %(rows)6d rows '
+                  '%(sql_count)7s queries pid %(pid)s' % event)
+
+        per_worker = defaultdict(lambda: [0, 0.])
+        for event in events:
+            per_worker[event['pid']][0] += event['rows']
+            per_worker[event['pid']][1] += event['wall']
+        print('Workers:')
+        for pid, (rows, wall) in sorted(per_worker.items()):
+            print('  pid %-8s %8d rows %10.2fs' % (pid, rows, wall))